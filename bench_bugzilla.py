@@ -0,0 +1,261 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks for the bugzilla module. Run this file to print their
+results:
+
+    python bench_bugzilla.py
+"""
+
+import sys
+import time
+import datetime
+import StringIO
+
+import bugzilla
+from test_bugzilla import MockBugzillaApi
+
+CONTENT_TYPES = ['text/plain', 'application/octet-stream', 'image/png']
+
+TIMESTAMPS = ['2010-04-%02dT%02d:16:59Z' % (day, hour)
+              for day in range(1, 29) for hour in range(0, 24, 6)]
+
+def make_attachment_json(i):
+    # Build every string afresh, like json.loads() would, so that
+    # interning has something to do.
+    return {
+        u'id': u'%d' % (100000 + i),
+        u'bug_id': u'%d' % (500000 + i / 10),
+        u'description': u'attachment number %d' % i,
+        u'content_type': u''.join(CONTENT_TYPES[i % len(CONTENT_TYPES)]),
+        u'is_patch': u'%d' % (i % 2),
+        u'is_obsolete': u'0',
+        u'creation_time': u''.join(TIMESTAMPS[i % len(TIMESTAMPS)]),
+        u'last_change_time': u''.join(TIMESTAMPS[(i * 7) % len(TIMESTAMPS)]),
+        u'attacher': {u'name': u'user%d@example.com' % (i % 50)}
+        }
+
+def best_time(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def legacy_set_bzprops(self, jsonobj):
+    # BugzillaObject._set_bzprops() as it was before its decoders
+    # were compiled per class.
+    for name, proptype in self.__bzprops__.items():
+        if name not in jsonobj:
+            raise KeyError("key '%s' not found in JSON "
+                           "%s object" % (name,
+                                          self.__class__.__name__))
+        if proptype == bool:
+            if isinstance(jsonobj[name], bool):
+                setattr(self, name, jsonobj[name])
+            elif jsonobj[name] == '0':
+                setattr(self, name, False)
+            elif jsonobj[name] == '1':
+                setattr(self, name, True)
+            else:
+                raise ValueError('bad boolean value: %s' %
+                                 repr(jsonobj[name]))
+        elif proptype in [int, unicode, str]:
+            setattr(self, name, proptype(jsonobj[name]))
+        elif proptype == datetime.datetime:
+            setattr(self, name,
+                    bugzilla.iso8601_to_datetime(jsonobj[name]))
+        else:
+            raise ValueError("bad proptype for '%s': %s" %
+                             (name, repr(proptype)))
+
+class UnslottedObject(object):
+    pass
+
+def bench_model_memory(count=100000):
+    """
+    Compares the memory used by slotted Attachment objects with that
+    of equivalent __dict__-backed objects.
+    """
+
+    bzapi = MockBugzillaApi()
+    attachments = [bugzilla.Attachment(make_attachment_json(i), bzapi)
+                   for i in range(count)]
+
+    slotted_size = sum([sys.getsizeof(a) for a in attachments])
+
+    unslotted_size = 0
+    for attachment in attachments:
+        obj = UnslottedObject()
+        for klass in type(attachment).__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                if name == '__weakref__':
+                    continue
+                if name.startswith('__'):
+                    name = '_%s%s' % (klass.__name__, name)
+                setattr(obj, name, getattr(attachment, name))
+        unslotted_size += sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+    content_types = len(set([id(a.content_type) for a in attachments]))
+
+    print "model memory (%d attachments):" % count
+    print "  __dict__ objects: %6.1f bytes each" % (
+        float(unslotted_size) / count
+        )
+    print "  slotted objects:  %6.1f bytes each" % (
+        float(slotted_size) / count
+        )
+    print "  distinct content_type strings: %d" % content_types
+
+class UntimedAttachment(bugzilla.BugzillaObject):
+    # Attachment without its timestamps, whose parsing would otherwise
+    # dominate the decoding benchmark.
+    __bzprops__ = dict([(name, proptype) for name, proptype
+                        in bugzilla.Attachment.__bzprops__.items()
+                        if proptype is not datetime.datetime])
+    __bzintern__ = bugzilla.Attachment.__bzintern__
+
+def bench_decode(count=5000):
+    """
+    Compares decoding the properties of attachments with the
+    per-class loaders against the old per-field type dispatch.
+    """
+
+    jsonobjs = [make_attachment_json(i) for i in range(count)]
+
+    print "property decoding (%d attachments):" % count
+    for klass in [bugzilla.Attachment, UntimedAttachment]:
+        bzapi = MockBugzillaApi()
+        pairs = [(klass(jsonobj, bzapi), jsonobj) for jsonobj in jsonobjs]
+
+        def legacy():
+            for obj, jsonobj in pairs:
+                legacy_set_bzprops(obj, jsonobj)
+
+        def compiled():
+            for obj, jsonobj in pairs:
+                obj._set_bzprops(jsonobj)
+
+        legacy_time = best_time(legacy)
+        compiled_time = best_time(compiled)
+        print "  %s:" % klass.__name__
+        print "    per-field dispatch: %6.1f ms" % (legacy_time * 1000)
+        print "    compiled loader:    %6.1f ms (%.1fx)" % (
+            compiled_time * 1000, legacy_time / compiled_time
+            )
+
+def bench_timestamps(count=20000):
+    """
+    Compares parsing timestamps with datetime.strptime(), with
+    parse_iso8601(), and with the memoizing iso8601_to_datetime().
+    """
+
+    timestamps = [u''.join(TIMESTAMPS[i % len(TIMESTAMPS)])
+                  for i in range(count)]
+
+    def strptime():
+        for timestamp in timestamps:
+            datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+
+    def sliced():
+        for timestamp in timestamps:
+            bugzilla.parse_iso8601(timestamp)
+
+    def memoized():
+        bugzilla.ISO8601_CACHE.clear()
+        for timestamp in timestamps:
+            bugzilla.iso8601_to_datetime(timestamp)
+
+    strptime_time = best_time(strptime)
+    print "timestamp parsing (%d timestamps, %d distinct):" % (
+        count, len(TIMESTAMPS)
+        )
+    print "  strptime:           %6.1f ms" % (strptime_time * 1000)
+    for name, func in [('parse_iso8601', sliced),
+                       ('iso8601_to_datetime', memoized)]:
+        elapsed = best_time(func)
+        print "  %-19s %6.1f ms (%.1fx)" % (name + ':', elapsed * 1000,
+                                            strptime_time / elapsed)
+
+def bench_lazy_decoding(count=200, attachments=100):
+    """
+    Compares loading bugs and reading only their ids and summaries
+    with eager and with lazy decoding.
+    """
+
+    jsonobjs = [{u'id': u'%d' % (500000 + i),
+                 u'summary': u'bug number %d' % i,
+                 u'attachments': [make_attachment_json(i * attachments + j)
+                                  for j in range(attachments)]}
+                for i in range(count)]
+
+    def load(config):
+        bzapi = MockBugzillaApi(config)
+        for jsonobj in jsonobjs:
+            bug = bugzilla.Bug(jsonobj, bzapi)
+            bug.id, bug.summary
+
+    eager_time = best_time(lambda: load({}))
+    lazy_time = best_time(lambda: load({'lazy_decoding': True}))
+    print "bug loading (%d bugs with %d attachments each):" % (
+        count, attachments
+        )
+    print "  eager decoding: %6.1f ms" % (eager_time * 1000)
+    print "  lazy decoding:  %6.1f ms (%.1fx)" % (lazy_time * 1000,
+                                                 eager_time / lazy_time)
+
+def bench_stream_reader(count=200, attachments=10):
+    """
+    Compares reading a search result's bugs one at a time with
+    JsonStreamReader against parsing the whole body with json.loads.
+    """
+
+    body = bugzilla.json.dumps({u'bugs': [
+        {u'id': u'%d' % (500000 + i),
+         u'summary': u'bug number %d' % i,
+         u'attachments': [make_attachment_json(i * attachments + j)
+                          for j in range(attachments)]}
+        for i in range(count)
+        ]})
+
+    def streamed():
+        reader = bugzilla.JsonStreamReader(StringIO.StringIO(body))
+        for key in reader.iter_members():
+            for bug in reader.iter_array():
+                pass
+
+    loads_time = best_time(lambda: bugzilla.json.loads(body))
+    stream_time = best_time(streamed)
+    print "search result parsing (%d bytes):" % len(body)
+    print "  json.loads:       %6.1f ms" % (loads_time * 1000)
+    print "  JsonStreamReader: %6.1f ms (%.1fx slower)" % (
+        stream_time * 1000, stream_time / loads_time
+        )
+
+def bench_decode_many(count=20000):
+    """
+    Compares decoding a list of bugs one at a time against decoding
+    them with Bug.decode_many().
+    """
+
+    jsonobjs = [{u'id': u'%d' % (500000 + i),
+                 u'summary': u'bug number %d' % i}
+                for i in range(count)]
+    bzapi = MockBugzillaApi()
+
+    single_time = best_time(lambda: [bugzilla.Bug(jsonobj, bzapi)
+                                     for jsonobj in jsonobjs])
+    many_time = best_time(lambda: bugzilla.Bug.decode_many(jsonobjs,
+                                                           bzapi))
+    print "batch decoding (%d bugs):" % count
+    print "  one at a time: %6.1f ms" % (single_time * 1000)
+    print "  decode_many:   %6.1f ms (%.1fx)" % (many_time * 1000,
+                                                single_time / many_time)
+
+BENCHMARKS = [bench_model_memory, bench_decode, bench_timestamps,
+              bench_lazy_decoding, bench_stream_reader, bench_decode_many]
+
+if __name__ == '__main__':
+    for benchmark in BENCHMARKS:
+        benchmark()
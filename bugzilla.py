@@ -2,12 +2,28 @@
 
 import os
 import sys
+import atexit
 import base64
+import codecs
+import errno
+import shutil
+import socket
+import sqlite3
+import tempfile
 import httplib
 import urllib
 import mimetypes
+import re
 import datetime
+import StringIO
+import collections
+import contextlib
+import weakref
+import threading
+import time
 from urlparse import urlparse
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 from getpass import getpass
 
 try:
@@ -15,80 +31,1238 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 DEFAULT_CONFIG = {
     'api_server': 'https://api-dev.bugzilla.mozilla.org/latest',
     'server': 'https://bugzilla.mozilla.org'
 }
 
-def json_request(method, url, query_args=None, body=None):
+def make_connection(scheme, netloc):
+    if scheme == 'https':
+        connclass = httplib.HTTPSConnection
+    elif scheme == 'http':
+        connclass = httplib.HTTPConnection
+    else:
+        raise ValueError('unknown scheme "%s"' % scheme)
+    return connclass(netloc)
+
+class ConnectionPool(object):
+    """
+    Keeps idle HTTP/1.1 connections alive, per host, so that later
+    requests can reuse them instead of paying for a new TCP and TLS
+    handshake each time. At most 'maxsize' idle connections are kept
+    per host, and connections idle for longer than 'idle_timeout'
+    seconds are discarded.
+
+    >>> pool = ConnectionPool(maxsize=1,
+    ...                       connect=lambda scheme, netloc: Mock(netloc))
+    >>> conn, reused = pool.get('http', 'foo')
+    >>> reused
+    False
+    >>> pool.put('http', 'foo', conn)
+    >>> pool.get('http', 'foo') == (conn, True)
+    True
+    >>> pool.put('http', 'foo', conn)
+    >>> pool.get('http', 'foo', reuse=False)[0] is conn
+    False
+    >>> pool.get('http', 'foo') == (conn, True)
+    True
+    >>> pool.put('http', 'foo', Mock('first'))
+    >>> pool.put('http', 'foo', Mock('second'))
+    Called second.close()
+    >>> pool.close()
+    Called first.close()
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=60.0,
+                 connect=make_connection, timer=time.time):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.__connect = connect
+        self.__timer = timer
+        self.__lock = threading.Lock()
+        self.__idle = {}
+
+    def get(self, scheme, netloc, reuse=True):
+        """
+        Returns a (connection, reused) tuple for the given host. If
+        'reuse' is false, a new connection is always made.
+        """
+
+        if not reuse:
+            return self.__connect(scheme, netloc), False
+        now = self.__timer()
+        expired = []
+        conn = None
+        with self.__lock:
+            idle = self.__idle.get((scheme, netloc), [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self.__connect(scheme, netloc), False
+
+    def put(self, scheme, netloc, conn):
+        with self.__lock:
+            idle = self.__idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, self.__timer()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+def encode_query_args(query_args):
+    """
+    Encodes the given dict as a query string. Values that are lists
+    are sent as one argument per item, and unicode is sent as UTF-8.
+
+    >>> encode_query_args({'match': [u'caf\\xe9', 'bob'], 'id': 5})
+    'id=5&match=caf%C3%A9&match=bob'
+    """
+
+    pairs = []
+    for name, value in sorted(query_args.items()):
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for item in value:
+            if isinstance(item, unicode):
+                item = item.encode('utf-8')
+            pairs.append((name, item))
+    return urllib.urlencode(pairs)
+
+# Requests that can safely be sent again if a reused connection turns
+# out to have been closed by the server. Others, like POST, could be
+# carried out twice, so they always get a new connection.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+def json_request(method, url, query_args=None, body=None, pool=None,
+                 headers=None, stream=False):
+    """
+    Makes a request and returns a dict describing its response. If
+    'stream' is true, the response's body isn't read. Instead, the
+    dict's 'body' is a ResponseStream that must be closed when the
+    caller is done with it.
+    """
+
     if query_args is None:
         query_args = {}
 
+    extra_headers = headers
     headers = {'Accept': 'application/json',
                'Content-Type': 'application/json'}
+    if extra_headers:
+        headers.update(extra_headers)
 
     urlparts = urlparse(url)
-    if urlparts.scheme == 'https':
-        connclass = httplib.HTTPSConnection
-    elif urlparts.scheme == 'http':
-        connclass = httplib.HTTPConnection
-    else:
-        raise ValueError('unknown scheme "%s"' % urlparts.scheme)
-    conn = connclass(urlparts.netloc)
     path = urlparts.path
     if query_args:
-        path += '?%s' % urllib.urlencode(query_args)
-    if body is not None:
+        path += '?%s' % encode_query_args(query_args)
+    if body is not None and not hasattr(body, 'read'):
         body = json.dumps(body)
-    conn.request(method, path, body, headers)
-    response = conn.getresponse()
-    status, reason = response.status, response.reason
-    mimetype = response.msg.gettype()
-    data = response.read()
-    conn.close()
 
-    if mimetype == 'application/json':
-        data = json.loads(data)
+    while True:
+        if pool is None:
+            conn = make_connection(urlparts.scheme, urlparts.netloc)
+            reused = False
+        else:
+            conn, reused = pool.get(urlparts.scheme, urlparts.netloc,
+                                    reuse=method in IDEMPOTENT_METHODS)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            if not stream:
+                data = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            if hasattr(body, 'rewind'):
+                body.rewind()
+            # The server closed the idle connection on its end, so
+            # try again with another one.
+            continue
+        break
+
+    def release():
+        if pool is None or response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            pool.put(urlparts.scheme, urlparts.netloc, conn)
+
+    mimetype = response.msg.gettype()
+    if stream:
+        data = ResponseStream(response, release)
+    else:
+        release()
+        if mimetype == 'application/json':
+            data = json.loads(data)
 
     return {'status': response.status,
             'reason': response.reason,
             'content_type': mimetype,
+            'etag': response.getheader('etag'),
+            'last_modified': response.getheader('last-modified'),
             'body': data}
 
-def make_caching_json_request(cache, json_request=json_request):
+class ResponseStream(object):
+    """
+    A file-like view of an HTTP response's body. Closing it hands
+    its connection back to the pool if the whole body was read, and
+    closes the connection otherwise.
+    """
+
+    def __init__(self, response, release):
+        self.__response = response
+        self.__release = release
+        self.closed = False
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.__response.read()
+        return self.__response.read(size)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__release()
+
+def make_pooled_json_request(pool, json_request=json_request):
+    def pooled_json_request(method, url, query_args=None, body=None,
+                            **kwargs):
+        return json_request(method=method,
+                            url=url,
+                            query_args=query_args,
+                            body=body,
+                            pool=pool,
+                            **kwargs)
+
+    return pooled_json_request
+
+AUTH_QUERY_ARGS = ['username', 'password']
+
+def normalize_query_value(value):
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            # Keep other byte strings distinct from any unicode string.
+            return {'bytes': value.encode('hex')}
+    return unicode(value)
+
+def canonical_cache_key(method, url, query_args=None, body=None,
+                        scope='user'):
+    """
+    Returns a string that identifies a request regardless of the order
+    of its query arguments and that never contains credentials.
+
+    If 'scope' is 'user', the key includes the username, so that every
+    user gets their own copy of the response. If it's 'public', the
+    username is left out, so that responses are shared by all users.
+
+    >>> canonical_cache_key('GET', 'http://foo/latest/bug/5',
+    ...                     {'username': 'bar', 'password': 'baz',
+    ...                      'b': 2, 'a': 1})
+    '["GET", "http://foo/latest/bug/5", [["a", "1"], ["b", "2"]], null, "bar"]'
+    >>> canonical_cache_key('GET', 'http://foo/latest/bug/5',
+    ...                     {'username': 'bar', 'password': 'baz'},
+    ...                     scope='public')
+    '["GET", "http://foo/latest/bug/5", [], null, null]'
+
+    UTF-8 byte strings get the same key as the unicode strings they
+    encode, since both are sent the same way:
+
+    >>> url = 'http://foo/latest/user'
+    >>> (canonical_cache_key('GET', url, {'match': 'caf\\xc3\\xa9'}) ==
+    ...  canonical_cache_key('GET', url, {'match': u'caf\\xe9'}))
+    True
+    """
+
+    if scope not in ['user', 'public']:
+        raise ValueError('unknown cache scope: %s' % repr(scope))
+    if query_args is None:
+        query_args = {}
+    args = []
+    for name, value in query_args.items():
+        if name in AUTH_QUERY_ARGS:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = [normalize_query_value(item) for item in value]
+        else:
+            value = normalize_query_value(value)
+        args.append([name, value])
+    args.sort()
+    user = None
+    if scope == 'user':
+        user = query_args.get('username')
+    return json.dumps([method, url, args, body, user], sort_keys=True)
+
+LAST_CHANGE_TIME_PROBE_PATH = re.compile(r'/(bug|attachment)/\d+$')
+
+def make_last_change_time_probe(kwargs, cached_response):
+    """
+    Given the arguments of a GET request for a bug or attachment and
+    its cached response, returns the arguments of a much smaller
+    request that only asks for the object's last_change_time. If it
+    matches the cached one, the cached response is still good.
+    Returns None if there's no such request.
+
+    >>> make_last_change_time_probe(
+    ...   {'method': 'GET', 'url': 'http://foo/latest/attachment/5',
+    ...    'query_args': {'attachmentdata': '1'}, 'body': None},
+    ...   {'body': {'last_change_time': '2010-04-13T18:02:00Z'}}
+    ...   )['query_args']
+    {'include_fields': 'last_change_time'}
+    >>> print make_last_change_time_probe(
+    ...   {'method': 'GET', 'url': 'http://foo/latest/user',
+    ...    'query_args': {'match': 'bob'}, 'body': None},
+    ...   {'body': {'users': []}}
+    ...   )
+    None
+    """
+
+    body = cached_response.get('body')
+    if (kwargs['method'] != 'GET' or
+        not isinstance(body, dict) or
+        'last_change_time' not in body or
+        not LAST_CHANGE_TIME_PROBE_PATH.search(urlparse(kwargs['url']).path)):
+        return None
+    query_args = dict(kwargs['query_args'] or {})
+    query_args.pop('attachmentdata', None)
+    query_args['include_fields'] = 'last_change_time'
+    return dict(kwargs, query_args=query_args)
+
+class CachePolicy(object):
+    """
+    Decides how long responses may be served from the cache.
+
+    'rules' is a list of (method, path_pattern, ttl) tuples, which may
+    also have a dict of query arguments as a fourth item. The first
+    rule whose method matches the request's, whose regular expression
+    is found in the request's path, and whose query arguments all
+    have the same values in the request applies. Requests that no
+    rule matches get 'default_ttl'. TTLs are in seconds: None means
+    forever and 0 means the response isn't cached at all. Only GET
+    requests with 2xx responses are ever cached.
+
+    Entries that have been stale for no more than
+    'stale_while_revalidate' seconds are returned right away while
+    they're refreshed in the background.
+
+    'scope' is passed to canonical_cache_key(). Only use 'public' if
+    none of the users sharing a cache can see anything the others
+    can't, such as security bugs.
+
+    >>> policy = CachePolicy()
+    >>> policy.ttl('GET', 'http://foo/latest/bug/5')
+    300
+    >>> policy.ttl('GET', 'http://foo/latest/user')
+    86400
+    >>> print policy.ttl('GET', 'http://foo/latest/attachment/5',
+    ...                  {'attachmentdata': '1'})
+    None
+    >>> policy.ttl('GET', 'http://foo/latest/attachment/5')
+    300
+    >>> policy.ttl('POST', 'http://foo/latest/bug/5/attachment')
+    0
+    """
+
+    DEFAULT_RULES = [
+        # Attachment contents never change, but their metadata, such
+        # as whether they're obsolete, does.
+        ('GET', r'/attachment/\d+$', None, {'attachmentdata': '1'}),
+        ('GET', r'/attachment/\d+$', 5 * 60),
+        ('GET', r'/user$', 24 * 60 * 60),
+        ('GET', r'/bug(/\d+)?$', 5 * 60)
+        ]
+
+    def __init__(self, rules=None, default_ttl=5 * 60,
+                 stale_while_revalidate=0, scope='user'):
+        if rules is None:
+            rules = self.DEFAULT_RULES
+        self.rules = []
+        for rule in rules:
+            method, pattern, ttl = rule[:3]
+            required_args = {}
+            if len(rule) > 3:
+                required_args = rule[3]
+            self.rules.append((method, re.compile(pattern), ttl,
+                               required_args))
+        self.default_ttl = default_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.scope = scope
+
+    def ttl(self, method, url, query_args=None):
+        if method != 'GET':
+            return 0
+        if query_args is None:
+            query_args = {}
+        path = urlparse(url).path
+        for rule_method, pattern, ttl, required_args in self.rules:
+            if rule_method == method and pattern.search(path):
+                for name, value in required_args.items():
+                    if query_args.get(name) != value:
+                        break
+                else:
+                    return ttl
+        return self.default_ttl
+
+    def is_cacheable(self, response):
+        return 200 <= response['status'] < 300
+
+def make_caching_json_request(cache, json_request=json_request,
+                              policy=None, timer=time.time):
+    """
+    >>> cache = {}
+    >>> now = [0]
+    >>> jsonreq = Mock('jsonreq')
+    >>> jsonreq.mock_returns = {'status': 200, 'body': 'hi'}
+    >>> cjr = make_caching_json_request(cache, jsonreq,
+    ...                                 timer=lambda: now[0])
+    >>> cjr('GET', 'http://foo/latest/bug/5')
+    Called jsonreq(
+        body=None,
+        method='GET',
+        query_args=None,
+        url='http://foo/latest/bug/5')
+    {'status': 200, 'body': 'hi'}
+    >>> now[0] = 299
+    >>> cjr('GET', 'http://foo/latest/bug/5')
+    {'status': 200, 'body': 'hi'}
+    >>> now[0] = 300
+    >>> cjr('GET', 'http://foo/latest/bug/5')
+    Called jsonreq(
+        body=None,
+        method='GET',
+        query_args=None,
+        url='http://foo/latest/bug/5')
+    {'status': 200, 'body': 'hi'}
+
+    Failed responses and anything but GET requests aren't cached:
+
+    >>> jsonreq.mock_returns = {'status': 404, 'body': 'nope'}
+    >>> cjr('GET', 'http://foo/latest/bug/6')
+    Called jsonreq(
+        body=None,
+        method='GET',
+        query_args=None,
+        url='http://foo/latest/bug/6')
+    {'status': 404, 'body': 'nope'}
+    >>> len(cache)
+    1
+    """
+
     from hashlib import sha1 as hashfunc
 
-    def caching_json_request(method, url, query_args=None, body=None):
-        key = hashfunc(repr((method, url, query_args, body))).hexdigest()
-        if not key in cache:
-            cache[key] = json_request(method=method,
-                                      url=url,
-                                      query_args=query_args,
-                                      body=body)
-        return cache[key]
+    if policy is None:
+        policy = CachePolicy()
+    refreshing = set()
+    refreshing_lock = threading.Lock()
+
+    def store(key, kwargs, response):
+        if policy.is_cacheable(response):
+            cache[key] = {'time': timer(), 'url': kwargs['url'],
+                          'response': response}
+        return response
+
+    def fetch(key, kwargs):
+        return store(key, kwargs, json_request(**kwargs))
+
+    def revalidate(key, entry, kwargs):
+        cached = entry['response']
+
+        conditional_headers = {}
+        if cached.get('etag'):
+            conditional_headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            conditional_headers['If-Modified-Since'] = cached['last_modified']
+        if conditional_headers:
+            response = json_request(headers=conditional_headers, **kwargs)
+            if response['status'] == 304:
+                response = cached
+            return store(key, kwargs, response)
+
+        probe_kwargs = make_last_change_time_probe(kwargs, cached)
+        if probe_kwargs is not None:
+            probe = json_request(**probe_kwargs)
+            if (policy.is_cacheable(probe) and
+                isinstance(probe['body'], dict) and
+                probe['body'].get('last_change_time') ==
+                cached['body']['last_change_time']):
+                return store(key, kwargs, cached)
+
+        return fetch(key, kwargs)
+
+    def refresh_in_background(key, entry, kwargs):
+        with refreshing_lock:
+            if key in refreshing:
+                return
+            refreshing.add(key)
+
+        def refresh():
+            try:
+                revalidate(key, entry, kwargs)
+            except Exception:
+                # The stale entry is kept, and the next request for
+                # it will try again.
+                pass
+            finally:
+                with refreshing_lock:
+                    refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def caching_json_request(method, url, query_args=None, body=None,
+                             stream=False):
+        kwargs = dict(method=method, url=url, query_args=query_args,
+                      body=body)
+        if stream:
+            return json_request(stream=True, **kwargs)
+        ttl = policy.ttl(method, url, query_args)
+        if ttl == 0:
+            return json_request(**kwargs)
+
+        key = hashfunc(canonical_cache_key(method, url, query_args, body,
+                                           policy.scope)).hexdigest()
+        try:
+            entry = cache[key]
+        except KeyError:
+            entry = None
+
+        # Entries written by older versions of this function have no
+        # timestamp, and are treated as expired.
+        if entry is not None and 'time' in entry:
+            age = timer() - entry['time']
+            if ttl is None or age < ttl:
+                return entry['response']
+            if age < ttl + policy.stale_while_revalidate:
+                refresh_in_background(key, entry, kwargs)
+                return entry['response']
+            return revalidate(key, entry, kwargs)
+
+        return fetch(key, kwargs)
 
     return caching_json_request
 
+def write_file_atomically(path, contents):
+    """
+    Writes 'contents' to a temporary file next to 'path' and then
+    renames it into place, so that readers never see a partly
+    written file.
+    """
+
+    with open_atomically(path) as fileobj:
+        fileobj.write(contents)
+
+@contextlib.contextmanager
+def open_atomically(path):
+    """
+    Yields a temporary file next to 'path', open for writing, which
+    is renamed into place if the block succeeds and removed if it
+    doesn't.
+    """
+
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    try:
+        tempfile_obj = os.fdopen(fd, 'wb')
+        try:
+            yield tempfile_obj
+        finally:
+            tempfile_obj.close()
+        try:
+            os.rename(temppath, path)
+        except OSError:
+            # Windows won't rename over an existing file.
+            os.remove(path)
+            os.rename(temppath, path)
+    except:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
 class JsonBlobCache(object):
-    def __init__(self, cachedir):
+    """
+    Stores JSON blobs as files under 'cachedir', sharded into
+    subdirectories named after the first two characters of their
+    keys. If 'max_size' is given, the least recently read or written
+    blobs are evicted whenever the total size of the cache exceeds it.
+    """
+
+    SIZE_FILENAME = 'size'
+    LOCK_FILENAME = 'lock'
+
+    # When evicting, the cache is shrunk to this fraction of max_size
+    # so that a full scan of the cache isn't needed on every write.
+    EVICT_TO = 0.9
+
+    def __init__(self, cachedir, max_size=None):
         self.cachedir = cachedir
+        self.max_size = max_size
+        self.__lock = threading.Lock()
 
     def __pathforkey(self, key):
         if not isinstance(key, basestring):
             raise ValueError('key must be a string')
-        return os.path.join(self.cachedir, '%s.json' % key)
+        return os.path.join(self.cachedir, key[:2], '%s.json' % key)
 
     def __getitem__(self, key):
-        if not key in self:
+        path = self.__pathforkey(key)
+        try:
+            contents = open(path, 'rb').read()
+        except IOError:
             raise KeyError(key)
-        return json.loads(open(self.__pathforkey(key)).read())
+        if self.max_size is not None:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return json.loads(contents)
 
     def __setitem__(self, key, value):
-        open(self.__pathforkey(key), 'w').write(json.dumps(value))
+        path = self.__pathforkey(key)
+        contents = json.dumps(value)
+        makedirs(os.path.dirname(path))
+        with self.__locked():
+            size = self.__load_size()
+            if os.path.exists(path):
+                old_size = os.path.getsize(path)
+            else:
+                old_size = 0
+            write_file_atomically(path, contents)
+            size += len(contents) - old_size
+            self.__save_size(size)
+        if self.max_size is not None and size > self.max_size:
+            self.evict(int(self.max_size * self.EVICT_TO))
 
     def __contains__(self, key):
         return os.path.exists(self.__pathforkey(key))
 
+    def __entries(self):
+        if not os.path.isdir(self.cachedir):
+            return
+        for shard in os.listdir(self.cachedir):
+            sharddir = os.path.join(self.cachedir, shard)
+            if not os.path.isdir(sharddir):
+                continue
+            for filename in os.listdir(sharddir):
+                if filename.endswith('.json'):
+                    path = os.path.join(sharddir, filename)
+                    try:
+                        yield path, os.stat(path)
+                    except OSError:
+                        pass
+
+    @contextlib.contextmanager
+    def __locked(self):
+        # The size file is shared by every instance and process using
+        # the directory, so it's only read and written while holding
+        # an exclusive lock on the directory's lock file, where the
+        # platform supports it.
+        with self.__lock:
+            makedirs(self.cachedir)
+            lockfile = open(os.path.join(self.cachedir,
+                                         self.LOCK_FILENAME), 'a')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+                yield
+            finally:
+                lockfile.close()
+
+    def __compute_size(self):
+        return sum([stat.st_size for path, stat in self.__entries()])
+
+    def __load_size(self):
+        try:
+            sizepath = os.path.join(self.cachedir, self.SIZE_FILENAME)
+            return int(open(sizepath).read())
+        except (IOError, ValueError):
+            return self.__compute_size()
+
+    def __save_size(self, size):
+        write_file_atomically(os.path.join(self.cachedir,
+                                           self.SIZE_FILENAME),
+                              str(size))
+
+    @property
+    def size(self):
+        """
+        The total size of the cached blobs, in bytes. This is kept in
+        a small file in the cache directory, so the directory only
+        needs to be scanned if that file is missing.
+        """
+
+        with self.__locked():
+            return self.__load_size()
+
+    def recompute_size(self):
+        with self.__locked():
+            size = self.__compute_size()
+            self.__save_size(size)
+            return size
+
+    def evict(self, target_size):
+        """
+        Removes the least recently used blobs until the cache is no
+        larger than 'target_size' bytes.
+        """
+
+        with self.__locked():
+            entries = [(stat.st_atime, stat.st_size, path)
+                       for path, stat in self.__entries()]
+            entries.sort()
+            size = sum([entry[1] for entry in entries])
+            for atime, entry_size, path in entries:
+                if size <= target_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= entry_size
+            self.__save_size(size)
+
+def describe_cache_entry(entry):
+    """
+    Returns an (object_type, object_id, bug_id) tuple describing what
+    a cache entry made by make_caching_json_request() holds. Any of
+    them may be None if they can't be determined.
+
+    >>> describe_cache_entry({'url': 'http://foo/latest/bug/5',
+    ...                       'response': {}})
+    ('bug', '5', 5)
+    >>> describe_cache_entry({'url': 'http://foo/latest/attachment/7',
+    ...                       'response': {'body': {'bug_id': '5'}}})
+    ('attachment', '7', 5)
+    >>> describe_cache_entry({'url': 'http://foo/latest/user',
+    ...                       'response': {}})
+    ('user', None, None)
+    >>> describe_cache_entry({})
+    (None, None, None)
+    """
+
+    if not isinstance(entry, dict) or 'url' not in entry:
+        return (None, None, None)
+    parts = urlparse(entry['url']).path.split('/')
+    object_id = None
+    bug_id = None
+    if len(parts) >= 2 and parts[-2] in ['bug', 'attachment']:
+        object_type, object_id = parts[-2:]
+    elif len(parts) >= 3 and parts[-3] == 'bug' and parts[-2].isdigit():
+        # Something belonging to a bug, like /bug/5/attachment.
+        object_type = parts[-1]
+        bug_id = int(parts[-2])
+    else:
+        object_type = parts[-1] or None
+    if object_type == 'bug' and object_id and object_id.isdigit():
+        bug_id = int(object_id)
+    elif object_type == 'attachment':
+        body = entry.get('response', {}).get('body')
+        if isinstance(body, dict) and 'bug_id' in body:
+            bug_id = int(body['bug_id'])
+    return (object_type, object_id, bug_id)
+
+class SqliteCache(object):
+    """
+    Stores JSON blobs in a single SQLite database, which several
+    threads and processes can share. Entries are indexed by the type
+    and bug of the object they hold and by when they were last read,
+    so that describe_cache_entry() metadata can be queried and evicted
+    without walking the whole cache. The total size of the entries is
+    kept up to date by triggers, so checking it against 'max_size'
+    doesn't have to add them all up.
+
+    >>> cache = SqliteCache(':memory:')
+    >>> cache['a'] = {'url': 'http://foo/latest/bug/5',
+    ...               'response': {'body': 'hi'}}
+    >>> cache['b'] = {'url': 'http://foo/latest/attachment/7',
+    ...               'response': {'body': {'bug_id': '5'}}}
+    >>> 'a' in cache
+    True
+    >>> cache['a']['response']
+    {u'body': u'hi'}
+    >>> cache.object_ids('attachment')
+    [u'7']
+    >>> cache.evict_bug(5)
+    2
+    >>> 'a' in cache
+    False
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS entries (
+             key TEXT PRIMARY KEY,
+             value TEXT NOT NULL,
+             object_type TEXT,
+             object_id TEXT,
+             bug_id INTEGER,
+             size INTEGER NOT NULL,
+             accessed REAL NOT NULL
+           )""",
+        """CREATE INDEX IF NOT EXISTS entries_object
+             ON entries (object_type, object_id)""",
+        """CREATE INDEX IF NOT EXISTS entries_bug_id
+             ON entries (bug_id)""",
+        """CREATE INDEX IF NOT EXISTS entries_accessed
+             ON entries (accessed)""",
+        """CREATE TABLE IF NOT EXISTS meta (
+             name TEXT PRIMARY KEY,
+             value INTEGER NOT NULL
+           )""",
+        """INSERT OR IGNORE INTO meta
+             SELECT 'size', COALESCE(SUM(size), 0) FROM entries""",
+        """CREATE TRIGGER IF NOT EXISTS entries_insert_size
+             AFTER INSERT ON entries BEGIN
+               UPDATE meta SET value = value + new.size
+                 WHERE name = 'size';
+             END""",
+        """CREATE TRIGGER IF NOT EXISTS entries_delete_size
+             AFTER DELETE ON entries BEGIN
+               UPDATE meta SET value = value - old.size
+                 WHERE name = 'size';
+             END""",
+        """CREATE TRIGGER IF NOT EXISTS entries_update_size
+             AFTER UPDATE OF size ON entries BEGIN
+               UPDATE meta SET value = value - old.size + new.size
+                 WHERE name = 'size';
+             END"""
+        ]
+
+    # How many of the least recently used entries evict() looks at at
+    # a time.
+    EVICT_BATCH_SIZE = 100
+
+    EVICT_TO = JsonBlobCache.EVICT_TO
+
+    def __init__(self, path, max_size=None, timer=time.time):
+        self.path = path
+        self.max_size = max_size
+        self.__timer = timer
+        self.__local = threading.local()
+        if path == ':memory:':
+            # Every connection to ':memory:' is a different database,
+            # so the threads have to share one.
+            self.__shared = self.__connect()
+        else:
+            self.__shared = None
+            self.__connection()
+
+    def __connect(self):
+        conn = sqlite3.connect(self.path, timeout=30,
+                               isolation_level=None,
+                               check_same_thread=self.path != ':memory:')
+        conn.execute('PRAGMA journal_mode=WAL')
+        # INSERT OR REPLACE only fires the delete trigger for the row
+        # it replaces when recursive triggers are on.
+        conn.execute('PRAGMA recursive_triggers=ON')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return conn
+
+    def __connection(self):
+        if self.__shared is not None:
+            return self.__shared
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = self.__connect()
+        return conn
+
+    def __getitem__(self, key):
+        conn = self.__connection()
+        row = conn.execute('SELECT value FROM entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                     (self.__timer(), key))
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, basestring):
+            raise ValueError('key must be a string')
+        contents = json.dumps(value)
+        object_type, object_id, bug_id = describe_cache_entry(value)
+        self.__connection().execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, contents, object_type, object_id, bug_id, len(contents),
+             self.__timer())
+            )
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict(int(self.max_size * self.EVICT_TO))
+
+    def __delitem__(self, key):
+        cursor = self.__connection().execute(
+            'DELETE FROM entries WHERE key = ?', (key,)
+            )
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        row = self.__connection().execute(
+            'SELECT 1 FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+        return row is not None
+
+    @property
+    def size(self):
+        return self.__size(self.__connection())
+
+    def __size(self, conn):
+        return conn.execute(
+            "SELECT value FROM meta WHERE name = 'size'"
+            ).fetchone()[0]
+
+    def object_ids(self, object_type):
+        rows = self.__connection().execute(
+            'SELECT DISTINCT object_id FROM entries '
+            'WHERE object_type = ? AND object_id IS NOT NULL '
+            'ORDER BY object_id', (object_type,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def evict_bug(self, bug_id):
+        """
+        Removes every entry for the given bug and its attachments, and
+        returns how many were removed.
+        """
+
+        cursor = self.__connection().execute(
+            'DELETE FROM entries WHERE bug_id = ?', (bug_id,)
+            )
+        return cursor.rowcount
+
+    def evict(self, target_size):
+        """
+        Removes the least recently used entries until the cache is no
+        larger than 'target_size' bytes.
+        """
+
+        conn = self.__connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            size = self.__size(conn)
+            while size > target_size:
+                rows = conn.execute(
+                    'SELECT key, size FROM entries ORDER BY accessed '
+                    'LIMIT ?', (self.EVICT_BATCH_SIZE,)
+                    ).fetchall()
+                if not rows:
+                    break
+                for key, entry_size in rows:
+                    if size <= target_size:
+                        break
+                    conn.execute('DELETE FROM entries WHERE key = ?',
+                                 (key,))
+                    size -= entry_size
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+class AttachmentDataStore(object):
+    """
+    Holds the contents of attachments, keeping at most 'max_memory'
+    bytes of them in memory. When that budget is exceeded, the least
+    recently used contents are moved to files in 'spill_dir', named
+    after their SHA-1 digests, and are read back from there when
+    they're next needed. If no 'spill_dir' is given, a temporary one
+    is made when needed and removed by close(), or when the program
+    exits. Without a 'spill_dir', contents larger than the whole
+    budget aren't stored at all.
+
+    >>> store = AttachmentDataStore(max_memory=8)
+    >>> store.put(1, 'abcd')
+    >>> store.put(2, 'efgh')
+    >>> store.get(1)
+    'abcd'
+    >>> store.put(3, 'ijkl')
+    >>> store.memory_size
+    8
+    >>> store.get(2)
+    'efgh'
+    >>> print store.get(4)
+    None
+    >>> store.put(5, 'too big to keep')
+    >>> print store.get(5), store.get(3)
+    None ijkl
+    >>> store.close()
+    """
+
+    def __init__(self, max_memory=16 * 1024 * 1024, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.memory_size = 0
+        self.__spills_to_temp_dir = spill_dir is None
+        self.__made_spill_dir = False
+        self.__memory = collections.OrderedDict()
+        self.__digests = {}
+        self.__lock = threading.Lock()
+
+    def get(self, attach_id):
+        """
+        Returns the contents of the given attachment, or None if they
+        aren't stored.
+        """
+
+        with self.__lock:
+            if attach_id in self.__memory:
+                data = self.__memory.pop(attach_id)
+                self.__memory[attach_id] = data
+                return data
+            digest = self.__digests.get(attach_id)
+        if digest is None:
+            return None
+        try:
+            data = open(self.__spill_path(digest), 'rb').read()
+        except IOError:
+            return None
+        self.put(attach_id, data)
+        return data
+
+    def put(self, attach_id, data):
+        evicted = []
+        with self.__lock:
+            if attach_id in self.__memory:
+                self.memory_size -= len(self.__memory.pop(attach_id))
+            if len(data) > self.max_memory and self.__spills_to_temp_dir:
+                # Keeping it would only mean spilling it at once, to a
+                # temporary directory made just for it.
+                self.__digests.pop(attach_id, None)
+                return
+            self.__memory[attach_id] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.max_memory:
+                evicted.append(self.__memory.popitem(last=False))
+                self.memory_size -= len(evicted[-1][1])
+        for evicted_id, evicted_data in evicted:
+            self.__spill(evicted_id, evicted_data)
+
+    def __spill_path(self, digest):
+        return os.path.join(self.spill_dir, digest[:2], digest)
+
+    def __spill(self, attach_id, data):
+        digest = sha1(data).hexdigest()
+        with self.__lock:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='bugzilla-')
+                self.__made_spill_dir = True
+                # In case close() is never called.
+                atexit.register(shutil.rmtree, self.spill_dir, True)
+        path = self.__spill_path(digest)
+        if not os.path.exists(path):
+            makedirs(os.path.dirname(path))
+            write_file_atomically(path, data)
+        with self.__lock:
+            self.__digests[attach_id] = digest
+
+    def close(self):
+        with self.__lock:
+            self.__memory.clear()
+            self.__digests.clear()
+            self.memory_size = 0
+            if self.__made_spill_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None
+                self.__made_spill_dir = False
+
+class BugMirror(object):
+    """
+    A local copy of a set of bugs, their attachments' metadata and
+    their attachers, kept in an SQLite database. Each call to sync()
+    only fetches the bugs that changed since the last one, and a
+    BugzillaApi whose 'mirror' is set loads objects from here
+    without making any requests.
+
+    >>> mirror = BugMirror(':memory:')
+    >>> bzapi = MockBugzillaApi()
+    >>> bzapi.request.mock_returns = {'bugs': [
+    ...   dict(TEST_BUG, last_change_time=u'2010-04-11T19:16:59Z')
+    ... ]}
+    >>> mirror.sync(bzapi, component='General')
+    Called bzapi.request(
+        'GET',
+        '/bug',
+        query_args={'component': 'General',
+                    'include_fields': '_default,attachments'})
+    1
+    >>> bzapi.request.mock_returns = {'bugs': []}
+    >>> mirror.sync(bzapi, component='General')
+    Called bzapi.request(
+        'GET',
+        '/bug',
+        query_args={'changed_after': u'2010-04-11T19:16:59Z',
+                    'component': 'General',
+                    'include_fields': '_default,attachments'})
+    0
+
+    >>> bzapi = MockBugzillaApi()
+    >>> bzapi.mirror = mirror
+    >>> bzapi.bugs.get(558680)
+    <Bug 558680 - u'Here is a summary'>
+    >>> bzapi.attachments.get(438381)
+    <Attachment 438381 - u'here is a description'>
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS bugs (
+             id INTEGER PRIMARY KEY,
+             json TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS attachments (
+             id INTEGER PRIMARY KEY,
+             bug_id INTEGER NOT NULL,
+             json TEXT NOT NULL
+           )""",
+        """CREATE INDEX IF NOT EXISTS attachments_bug_id
+             ON attachments (bug_id)""",
+        """CREATE TABLE IF NOT EXISTS users (
+             name TEXT PRIMARY KEY,
+             json TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS cursors (
+             query TEXT PRIMARY KEY,
+             last_change_time TEXT NOT NULL
+           )"""
+        ]
+
+    TABLES = {
+        'Bug': ('bugs', 'id'),
+        'Attachment': ('attachments', 'id'),
+        'User': ('users', 'name')
+        }
+
+    DEFAULT_FIELDS = '_default,attachments'
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, timeout=30,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.__conn.execute(statement)
+
+    def get_json(self, kind, key):
+        """
+        Returns the mirrored JSON for the Bug, Attachment or User with
+        the given key, or None if it isn't mirrored.
+        """
+
+        if kind not in self.TABLES:
+            return None
+        table, column = self.TABLES[kind]
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT json FROM %s WHERE %s = ?' % (table, column),
+                (key,)
+                ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def __query_key(self, criteria):
+        return json.dumps(sorted(criteria.items()))
+
+    def cursor(self, **criteria):
+        """
+        Returns the last_change_time of the most recently changed bug
+        seen by sync() for the given criteria, or None.
+        """
+
+        with self.__lock:
+            row = self.__conn.execute(
+                'SELECT last_change_time FROM cursors WHERE query = ?',
+                (self.__query_key(criteria),)
+                ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def sync(self, bzapi, include_fields=DEFAULT_FIELDS, **criteria):
+        """
+        Fetches the bugs matching the given search criteria that changed
+        since the last sync, stores them, and returns how many there
+        were.
+        """
+
+        query_args = dict(criteria)
+        query_args['include_fields'] = include_fields
+        cursor = self.cursor(**criteria)
+        if cursor is not None:
+            query_args['changed_after'] = cursor
+
+        bugs = bzapi.request('GET', '/bug', query_args=query_args)['bugs']
+
+        with self.__lock:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            try:
+                for bug in bugs:
+                    self.__store_bug(bug)
+                    if bug.get('last_change_time') > cursor:
+                        cursor = bug['last_change_time']
+                if cursor is not None:
+                    self.__conn.execute(
+                        'INSERT OR REPLACE INTO cursors VALUES (?, ?)',
+                        (self.__query_key(criteria), cursor)
+                        )
+                self.__conn.execute('COMMIT')
+            except:
+                self.__conn.execute('ROLLBACK')
+                raise
+        return len(bugs)
+
+    def __store_bug(self, bug):
+        self.__conn.execute('INSERT OR REPLACE INTO bugs VALUES (?, ?)',
+                            (int(bug['id']), json.dumps(bug)))
+        for attachment in bug.get('attachments', []):
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)',
+                (int(attachment['id']), int(bug['id']),
+                 json.dumps(attachment))
+                )
+            self.__store_user(attachment['attacher'])
+
+    def __store_user(self, user):
+        # Attachers often come with nothing but a name, which shouldn't
+        # replace a fuller copy of the user.
+        row = self.__conn.execute('SELECT json FROM users WHERE name = ?',
+                                  (user['name'],)).fetchone()
+        if row is None or len(user) >= len(json.loads(row[0])):
+            self.__conn.execute('INSERT OR REPLACE INTO users VALUES (?, ?)',
+                                (user['name'], json.dumps(user)))
+
 def getpass_or_die(prompt, getpass=getpass):
     try:
         password = getpass(prompt)
@@ -124,18 +1298,97 @@ class BugzillaApi(object):
         if config is None:
             config = load_config(getpass=getpass)
 
+        self.connection_pool = None
         if jsonreq is None:
-            if 'cache_dir' in config:
-                cache = JsonBlobCache(os.path.expanduser(config['cache_dir']))
-                jsonreq = make_caching_json_request(cache)
-            else:
-                jsonreq = json_request
+            self.connection_pool = ConnectionPool(
+                maxsize=config.get('max_connections', 4),
+                idle_timeout=config.get('connection_idle_timeout', 60.0)
+                )
+            jsonreq = make_pooled_json_request(self.connection_pool)
+            cache = None
+            if 'cache_db' in config:
+                cache = SqliteCache(os.path.expanduser(config['cache_db']),
+                                    max_size=config.get('cache_max_size'))
+            elif 'cache_dir' in config:
+                cache = JsonBlobCache(os.path.expanduser(config['cache_dir']),
+                                      max_size=config.get('cache_max_size'))
+            if cache is not None:
+                policy = CachePolicy(
+                    rules=config.get('cache_rules'),
+                    stale_while_revalidate=config.get(
+                        'cache_stale_while_revalidate', 0),
+                    scope=config.get('cache_scope', 'user')
+                    )
+                jsonreq = make_caching_json_request(cache, jsonreq,
+                                                    policy=policy)
+
+        self.mirror = None
+        if 'mirror_db' in config:
+            self.mirror = BugMirror(os.path.expanduser(config['mirror_db']))
+
+        self.attachment_data = AttachmentDataStore(
+            max_memory=config.get('attachment_memory_budget',
+                                  16 * 1024 * 1024),
+            spill_dir=config.get('attachment_spill_dir')
+            )
 
         self.config = config
+        self.lazy_decoding = config.get('lazy_decoding', False)
+        self.max_workers = config.get('max_workers', 8)
         self.__jsonreq = jsonreq
-        self.users = LazyMapping(self, User, keytype=unicode)
-        self.bugs = LazyMapping(self, Bug, keytype=int)
-        self.attachments = Attachments(self)
+        self.__executor = None
+        self.__executor_lock = threading.Lock()
+        self.__in_flight = {}
+        self.__in_flight_lock = threading.Lock()
+        self.request_count = 0
+        identity_maps = config.get('identity_maps', {})
+        self.users = LazyMapping(self, User, keytype=unicode,
+                                 identity_map=identity_maps.get('users'))
+        self.bugs = Bugs(self, batch_size=config.get('batch_size', 100),
+                         identity_map=identity_maps.get('bugs'))
+        self.attachments = Attachments(
+            self, identity_map=identity_maps.get('attachments')
+            )
+
+    @property
+    def executor(self):
+        """
+        A pool of 'max_workers' threads that concurrent requests
+        are made on.
+        """
+
+        with self.__executor_lock:
+            if self.__executor is None:
+                self.__executor = ThreadPool(self.max_workers)
+            return self.__executor
+
+    def map(self, func, iterable):
+        """
+        Like the built-in map(), but calls 'func' concurrently on the
+        executor. This must not be called from the executor's own
+        threads.
+        """
+
+        return self.executor.map(func, iterable)
+
+    def map_requests(self, requests):
+        """
+        Makes the given requests concurrently and returns their
+        responses, in order. Each request is a tuple of arguments to
+        request().
+        """
+
+        return self.map(lambda args: self.request(*args), requests)
+
+    def close(self):
+        with self.__executor_lock:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.close()
+            executor.join()
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+        self.attachment_data.close()
 
     @property
     def current_user(self):
@@ -143,20 +1396,83 @@ class BugzillaApi(object):
         # logged-in.
         return self.users.get(self.config['username'])
 
-    def request(self, method, path, query_args=None, body=None):
+    def request(self, method, path, query_args=None, body=None,
+                stream=False):
+        """
+        Makes a request to the API and returns its JSON response. If
+        'stream' is true, a file-like object that the JSON response
+        can be read from is returned instead, and the caller must close
+        it when done.
+
+        Identical GET requests made while one of them is in flight
+        share its network call and its response, or its exception.
+        'request_count' is the number of calls actually made.
+        """
+
         if query_args is None:
             query_args = {}
+        else:
+            query_args = dict(query_args)
 
         if 'username' in self.config and 'password' in self.config:
-            for name in ['username', 'password']:
+            for name in AUTH_QUERY_ARGS:
                 query_args[name] = self.config[name]
 
         url = '%s%s' % (self.config['api_server'], path)
 
+        if method != 'GET' or stream:
+            return self.__send(method, url, query_args, body, stream)
+
+        key = canonical_cache_key(method, url, query_args, body)
+        with self.__in_flight_lock:
+            pending = self.__in_flight.get(key)
+            if pending is not None:
+                leader = False
+            else:
+                leader = True
+                pending = self.__in_flight[key] = PendingResult()
+        if not leader:
+            return pending.get()
+
+        try:
+            response = self.__send(method, url, query_args, body, stream)
+        except:
+            exc_info = sys.exc_info()
+            with self.__in_flight_lock:
+                del self.__in_flight[key]
+            pending.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        with self.__in_flight_lock:
+            del self.__in_flight[key]
+        pending.set(response)
+        return response
+
+    def __send(self, method, url, query_args, body, stream):
+        with self.__in_flight_lock:
+            self.request_count += 1
+
+        kwargs = {}
+        if stream:
+            kwargs['stream'] = True
+
         response = self.__jsonreq(method=method,
                                   url=url,
                                   query_args=query_args,
-                                  body=body)
+                                  body=body,
+                                  **kwargs)
+
+        if stream:
+            if (response['status'] == 200 and
+                response['content_type'] == 'application/json'):
+                return response['body']
+            stream = response['body']
+            try:
+                response['body'] = stream.read()
+            finally:
+                stream.close()
+            if response['content_type'] == 'application/json':
+                response['body'] = json.loads(response['body'])
+            raise BugzillaApiError(response)
 
         if response['content_type'] == 'application/json':
             json_response = response['body']
@@ -165,77 +1481,1329 @@ class BugzillaApi(object):
             return json_response
         raise BugzillaApiError(response)
 
+    def iter_request(self, method, path, key, query_args=None, body=None,
+                     chunk_size=65536):
+        """
+        Makes a request to the API and yields the elements of the
+        array that is the 'key' member of its JSON response. Each one
+        is parsed as soon as it's come off the socket, instead of the
+        whole response being read and parsed first. Responses read
+        this way aren't cached, and take about three times as much CPU
+        to parse as a json.loads() of the whole body, in exchange for
+        the memory.
+
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = StringIO.StringIO(
+        ...   '{"bugs": [{"id": "1"}, {"id": "2"}]}'
+        ... )
+        >>> for bug in bzapi.iter_request('GET', '/bug', 'bugs'):
+        ...     print bug
+        Called bzapi.request('GET', '/bug', body=None, query_args=None,
+                             stream=True)
+        {u'id': u'1'}
+        {u'id': u'2'}
+        """
+
+        stream = self.request(method, path, query_args=query_args,
+                              body=body, stream=True)
+        try:
+            reader = JsonStreamReader(stream, chunk_size)
+            for member in reader.iter_members():
+                if member == 'error':
+                    error = reader.read_value()
+                    if error:
+                        raise BugzillaApiError(error)
+                elif member == key:
+                    for item in reader.iter_array():
+                        yield item
+        finally:
+            stream.close()
+
+    def request_async(self, method, path, query_args=None, body=None,
+                      callback=None):
+        """
+        Like request(), but returns an AsyncResult right away instead
+        of blocking. At most 'max_workers' requests run at once. If
+        'callback' is given, it's called with the response from a
+        worker thread, which lets event loops be notified without
+        blocking on the result.
+        """
+
+        return self.executor.apply_async(self.request,
+                                         (method, path, query_args, body),
+                                         callback=callback)
+
 class BugzillaApiError(Exception):
     pass
 
+def get_file_size(fileobj):
+    """
+    Returns the number of bytes left to read in the given file.
+    Raises ValueError if the file can't be seeked, like a pipe.
+    """
+
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError):
+        try:
+            start = fileobj.tell()
+            fileobj.seek(0, 2)
+            end = fileobj.tell()
+            fileobj.seek(start)
+        except (AttributeError, IOError, OSError):
+            raise ValueError('could not find the size of the file; give '
+                             'a seekable file or its size')
+        return end - start
+
+class Base64JsonBody(object):
+    """
+    A file-like JSON request body made of the given fields plus
+    'key', whose value is the base64 encoding of the next 'size' bytes
+    of 'fileobj'. The file is read and encoded a piece at a time as
+    the body is sent, and the body's length is known up front.
+
+    >>> body = Base64JsonBody({'a': 1}, 'data',
+    ...                       StringIO.StringIO('testing!'), 8)
+    >>> len(body)
+    32
+    >>> body.read(12), body.read()
+    ('{"a": 1, "da', 'ta": "dGVzdGluZyE="}')
+    >>> body.read()
+    ''
+    """
+
+    def __init__(self, fields, key, fileobj, size, chunk_size=3 * 16384):
+        head = json.dumps(fields)
+        if fields:
+            head = head[:-1] + ', '
+        else:
+            head = '{'
+        self.__head = head + '%s: "' % json.dumps(key)
+        self.__tail = '"}'
+        self.__fileobj = fileobj
+        self.__size = size
+        self.__chunk_size = chunk_size
+        try:
+            self.__start = fileobj.tell()
+        except (AttributeError, IOError):
+            self.__start = None
+        self.__length = (len(self.__head) + 4 * ((size + 2) // 3) +
+                         len(self.__tail))
+        self.__reset()
+
+    def __len__(self):
+        return self.__length
+
+    def rewind(self):
+        """
+        Starts the body over, so that it can be sent again. Raises
+        IOError if the underlying file can't be rewound.
+        """
+
+        if self.__remaining < self.__size:
+            if self.__start is None:
+                raise IOError('body can not be rewound')
+            self.__fileobj.seek(self.__start)
+        self.__reset()
+
+    def __reset(self):
+        self.__buffer = self.__head
+        self.__remaining = self.__size
+        self.__leftover = ''
+        self.__done = False
+
+    def __encode_more(self):
+        if self.__remaining:
+            data = self.__fileobj.read(min(self.__chunk_size,
+                                           self.__remaining))
+            if not data:
+                raise IOError('file ended %d bytes early' %
+                              self.__remaining)
+            self.__remaining -= len(data)
+            data = self.__leftover + data
+            if self.__remaining:
+                usable = len(data) - len(data) % 3
+            else:
+                usable = len(data)
+            self.__leftover = data[usable:]
+            self.__buffer += base64.b64encode(data[:usable])
+        else:
+            self.__buffer += self.__tail
+            self.__done = True
+
+    def read(self, size=-1):
+        while not self.__done and (size < 0 or len(self.__buffer) < size):
+            self.__encode_more()
+        if size < 0:
+            size = len(self.__buffer)
+        data = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return data
+
+class JsonStreamReader(object):
+    """
+    A pull parser for JSON documents that are too big to hold in
+    memory at once. Strings are scanned with str.find(), so long
+    ones like attachment data are cheap to stream through, and
+    whole values are skipped over with regular expressions. Reading
+    a value still costs a few times what json.loads() would, since
+    the value is scanned once here and once more by json.loads().
+
+    >>> reader = JsonStreamReader(StringIO.StringIO(
+    ...   '{"a": {"b": [1, "}"]}, "c": "hi\\\\nthere", "d": 5}'
+    ... ), chunk_size=4)
+    >>> for key in reader.iter_members():
+    ...     if key == 'c':
+    ...         print list(reader.iter_string())
+    ...     elif key == 'd':
+    ...         print reader.read_value()
+    [u'hi\\n', u'the', u're']
+    5
+    """
+
+    WHITESPACE = ' \t\r\n'
+
+    # Matches everything up to the next bracket that isn't inside a
+    # string, or up to the opening quote of a string that goes past
+    # the end of the buffer.
+    SKIP = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+    SCALAR_END = re.compile(r'[,}\] \t\r\n]')
+
+    def __init__(self, fileobj, chunk_size=65536):
+        self.__fileobj = fileobj
+        self.__chunk_size = chunk_size
+        self.__buffer = ''
+        self.__pos = 0
+        self.__consumed = True
+
+    def __fill(self):
+        chunk = self.__fileobj.read(self.__chunk_size)
+        if not chunk:
+            return False
+        self.__buffer = self.__buffer[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+    def __current(self):
+        if self.__pos >= len(self.__buffer) and not self.__fill():
+            return ''
+        return self.__buffer[self.__pos]
+
+    def __peek(self):
+        while True:
+            char = self.__current()
+            if char == '' or char not in self.WHITESPACE:
+                return char
+            self.__pos += 1
+
+    def __next(self):
+        char = self.__peek()
+        if char == '':
+            raise ValueError('unexpected end of JSON')
+        self.__pos += 1
+        return char
+
+    def __expect(self, expected):
+        char = self.__next()
+        if char != expected:
+            raise ValueError('expected %s but found %s' % (repr(expected),
+                                                           repr(char)))
+
+    def __iter_raw_string(self):
+        """
+        Yields pieces of the string whose opening quote was just read,
+        still JSON-escaped, but never splitting an escape sequence.
+        """
+
+        while True:
+            buf = self.__buffer
+            quote = buf.find('"', self.__pos)
+            if quote == -1:
+                end = len(buf)
+            else:
+                end = quote
+            backslash = buf.find('\\', self.__pos, end)
+            if backslash != -1:
+                if buf[backslash + 1:backslash + 2] == 'u':
+                    escape_end = backslash + 6
+                else:
+                    escape_end = backslash + 2
+                if escape_end > len(buf):
+                    if not self.__fill():
+                        raise ValueError('unterminated string')
+                    continue
+                yield buf[self.__pos:escape_end]
+                self.__pos = escape_end
+            elif quote != -1:
+                if quote > self.__pos:
+                    yield buf[self.__pos:quote]
+                self.__pos = quote + 1
+                return
+            else:
+                if len(buf) > self.__pos:
+                    yield buf[self.__pos:]
+                self.__pos = len(buf)
+                if not self.__fill():
+                    raise ValueError('unterminated string')
+
+    def __raw_value(self):
+        char = self.__peek()
+        if char == '"':
+            self.__pos += 1
+            return '"%s"' % ''.join(self.__iter_raw_string())
+        if char in ['{', '[']:
+            return self.__raw_container()
+        parts = []
+        while True:
+            buf = self.__buffer
+            match = self.SCALAR_END.search(buf, self.__pos)
+            if match is None:
+                end = len(buf)
+            else:
+                end = match.start()
+            parts.append(buf[self.__pos:end])
+            self.__pos = end
+            if match is not None or not self.__fill():
+                break
+        value = ''.join(parts)
+        if not value:
+            raise ValueError('expected a JSON value')
+        return value
+
+    def __raw_container(self):
+        parts = []
+        depth = 0
+        while True:
+            buf = self.__buffer
+            end = self.SKIP.match(buf, self.__pos).end()
+            char = buf[end:end + 1]
+            parts.append(buf[self.__pos:end + 1])
+            self.__pos = end + len(char)
+            if char == '':
+                if not self.__fill():
+                    raise ValueError('unexpected end of JSON')
+            elif char == '"':
+                parts.extend(self.__iter_raw_string())
+                parts.append('"')
+            elif char == '{' or char == '[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return ''.join(parts)
+
+    def iter_members(self):
+        """
+        Yields the keys of the JSON object being read. For each key,
+        the caller may call read_value(), skip_value() or iter_string()
+        to get its value; otherwise, the value is skipped.
+        """
+
+        self.__expect('{')
+        if self.__peek() == '}':
+            self.__pos += 1
+            return
+        while True:
+            self.__expect('"')
+            key = json.loads('"%s"' % ''.join(self.__iter_raw_string()))
+            self.__expect(':')
+            self.__consumed = False
+            yield key
+            if not self.__consumed:
+                self.skip_value()
+            char = self.__next()
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('expected , or } but found %s' %
+                                 repr(char))
+
+    def iter_array(self):
+        """
+        Yields the elements of the array value being read, parsing
+        each one as soon as it's been read, so that the whole array is
+        never in memory at once. It must be iterated to the end.
+
+        >>> reader = JsonStreamReader(StringIO.StringIO(
+        ...   '{"bugs": [{"id": 1}, {"s": "]"}, [] ]}'
+        ... ), chunk_size=4)
+        >>> for key in reader.iter_members():
+        ...     for bug in reader.iter_array():
+        ...         print bug
+        {u'id': 1}
+        {u's': u']'}
+        []
+        """
+
+        self.__consumed = True
+        self.__expect('[')
+        if self.__peek() == ']':
+            self.__pos += 1
+            return
+        while True:
+            yield json.loads(self.__raw_value())
+            char = self.__next()
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('expected , or ] but found %s' %
+                                 repr(char))
+
+    def read_value(self):
+        self.__consumed = True
+        return json.loads(self.__raw_value())
+
+    def skip_value(self):
+        self.__consumed = True
+        self.__raw_value()
+
+    def iter_string(self):
+        """
+        Yields the decoded pieces of the string value being read. It
+        must be iterated to the end.
+        """
+
+        self.__consumed = True
+        self.__expect('"')
+        # Pieces can end in the middle of a multi-byte character, whose
+        # remaining bytes the decoder holds on to until the next piece.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for raw in self.__iter_raw_string():
+            backslash = raw.find('\\')
+            if backslash == -1:
+                text = decoder.decode(raw)
+            else:
+                text = (decoder.decode(raw[:backslash]) +
+                        json.loads('"%s"' % raw[backslash:]))
+            if text:
+                yield text
+        text = decoder.decode('', True)
+        if text:
+            yield text
+
+class Base64Decoder(object):
+    """
+    Decodes base64 that arrives in arbitrarily sized pieces.
+
+    >>> decoder = Base64Decoder()
+    >>> decoder.feed('dGVz'), decoder.feed('dGl'), decoder.feed('uZyE=')
+    ('tes', '', 'ting!')
+    >>> decoder.finish()
+    ''
+    """
+
+    def __init__(self):
+        self.__pending = ''
+
+    def feed(self, text):
+        text = self.__pending + ''.join(str(text).split())
+        usable = len(text) - len(text) % 4
+        self.__pending = text[usable:]
+        return base64.b64decode(text[:usable])
+
+    def finish(self):
+        if self.__pending:
+            raise ValueError('truncated base64 data')
+        return ''
+
+def parse_iso8601(timestamp):
+    """
+    Parses an ISO 8601 timestamp into a naive UTC datetime by slicing
+    it, which is much faster than datetime.strptime(). Fractional
+    seconds and 'Z', '+HH:MM', '+HHMM' and '+HH' suffixes are
+    supported; timestamps without a suffix are assumed to be in UTC.
+
+    >>> parse_iso8601('2010-04-11T19:16:59Z')
+    datetime.datetime(2010, 4, 11, 19, 16, 59)
+    >>> parse_iso8601('2010-04-11T21:16:59.25+02:00')
+    datetime.datetime(2010, 4, 11, 19, 16, 59, 250000)
+    >>> parse_iso8601('2010-04-11T14:46:59-0430')
+    datetime.datetime(2010, 4, 11, 19, 16, 59)
+    >>> parse_iso8601('2010-04-11 19:16:59')
+    datetime.datetime(2010, 4, 11, 19, 16, 59)
+    >>> parse_iso8601('April 11, 2010')
+    Traceback (most recent call last):
+    ...
+    ValueError: bad ISO 8601 timestamp: 'April 11, 2010'
+    """
+
+    try:
+        if (timestamp[4] != '-' or timestamp[7] != '-' or
+            timestamp[10] not in 'T ' or timestamp[13] != ':' or
+            timestamp[16] != ':'):
+            raise ValueError()
+        result = datetime.datetime(int(timestamp[0:4]),
+                                   int(timestamp[5:7]),
+                                   int(timestamp[8:10]),
+                                   int(timestamp[11:13]),
+                                   int(timestamp[14:16]),
+                                   int(timestamp[17:19]))
+        suffix = timestamp[19:]
+        if suffix.startswith('.'):
+            end = 1
+            while end < len(suffix) and suffix[end].isdigit():
+                end += 1
+            fraction = (suffix[1:end] + '000000')[:6]
+            result = result.replace(microsecond=int(fraction))
+            suffix = suffix[end:]
+        if suffix in ['', 'Z']:
+            return result
+        offset = suffix[1:].replace(':', '')
+        if suffix[0] not in '+-' or len(offset) not in [2, 4]:
+            raise ValueError()
+        delta = datetime.timedelta(hours=int(offset[:2]),
+                                   minutes=int(offset[2:] or '0'))
+        if suffix[0] == '+':
+            return result - delta
+        return result + delta
+    except (IndexError, ValueError):
+        raise ValueError('bad ISO 8601 timestamp: %s' % repr(timestamp))
+
+ISO8601_CACHE = {}
+ISO8601_CACHE_SIZE = 4096
+
 def iso8601_to_datetime(timestamp):
     """
+    Like parse_iso8601(), but remembers the results for recently seen
+    timestamps, which repeat a lot across the attachments of a bug.
+
     >>> iso8601_to_datetime('2010-04-11T19:16:59Z')
     datetime.datetime(2010, 4, 11, 19, 16, 59)
     """
 
-    return datetime.datetime.strptime(timestamp,
-                                      "%Y-%m-%dT%H:%M:%SZ")
+    try:
+        return ISO8601_CACHE[timestamp]
+    except KeyError:
+        pass
+    result = parse_iso8601(timestamp)
+    if len(ISO8601_CACHE) >= ISO8601_CACHE_SIZE:
+        ISO8601_CACHE.clear()
+    ISO8601_CACHE[timestamp] = result
+    return result
+
+INTERNED_STRINGS = {}
+INTERNED_STRINGS_SIZE = 10000
+
+def intern_string(string):
+    """
+    Like intern(), but works for unicode strings too. At most
+    INTERNED_STRINGS_SIZE unicode strings are remembered, so that
+    long-running processes don't keep every string they've seen.
+
+    >>> intern_string(u''.join([u'a', u'b'])) is intern_string(u'ab')
+    True
+    """
+
+    if isinstance(string, str):
+        return intern(string)
+    try:
+        return INTERNED_STRINGS[string]
+    except KeyError:
+        pass
+    if len(INTERNED_STRINGS) >= INTERNED_STRINGS_SIZE:
+        INTERNED_STRINGS.clear()
+    INTERNED_STRINGS[string] = string
+    return string
+
+def decode_bool(value):
+    """
+    >>> decode_bool(True), decode_bool('0'), decode_bool('1')
+    (True, False, True)
+    >>> decode_bool('yes')
+    Traceback (most recent call last):
+    ...
+    ValueError: bad boolean value: 'yes'
+    """
+
+    if isinstance(value, bool):
+        return value
+    if value == '0':
+        return False
+    if value == '1':
+        return True
+    raise ValueError('bad boolean value: %s' % repr(value))
+
+def decode_datetime(value):
+    return iso8601_to_datetime(value)
+
+PROPTYPE_DECODERS = {
+    bool: decode_bool,
+    int: int,
+    unicode: unicode,
+    str: str,
+    datetime.datetime: decode_datetime
+    }
+
+def make_interning_decoder(decode):
+    def decode_and_intern(value):
+        return intern_string(decode(value))
+    return decode_and_intern
+
+class BugzillaObjectType(type):
+    """
+    Gives each of this module's BugzillaObject subclasses, and any
+    other subclass that defines __bzslots__, a slot for each of its
+    __bzprops__ and for each name in its __bzslots__, so that its
+    instances don't need a __dict__. Other subclasses are left alone,
+    so their instances get a __dict__ as usual, unless they define
+    __slots__ themselves.
+
+    It also works out, once per class, which function decodes each
+    of the class' __bzprops__, storing them in __bzdecoders__, and
+    generates a __bzloader__ function that sets all of them at once
+    without any per-field dispatch. Lazily decoded objects look their
+    decoders up in __bzdecodermap__ instead.
+    """
+
+    def __new__(meta, name, bases, namespace):
+        if '__slots__' not in namespace and (
+            namespace.get('__module__') == __name__ or
+            '__bzslots__' in namespace):
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(getattr(klass, '__slots__', ()))
+            slots = [prop for prop in namespace.get('__bzprops__', {})
+                     if prop not in inherited]
+            slots.extend(namespace.get('__bzslots__', ()))
+            namespace['__slots__'] = tuple(slots)
+        klass = type.__new__(meta, name, bases, namespace)
+        klass.__bzdecoders__ = meta.compile_decoders(klass)
+        klass.__bzdecodermap__ = dict(klass.__bzdecoders__)
+        klass.__bzloader__ = staticmethod(meta.compile_loader(klass))
+        return klass
+
+    @staticmethod
+    def compile_decoders(klass):
+        decoders = []
+        for name, proptype in sorted(klass.__bzprops__.items()):
+            if proptype not in PROPTYPE_DECODERS:
+                raise ValueError("bad proptype for '%s': %s" %
+                                 (name, repr(proptype)))
+            decode = PROPTYPE_DECODERS[proptype]
+            if name in klass.__bzintern__:
+                decode = make_interning_decoder(decode)
+            decoders.append((name, decode))
+        return tuple(decoders)
+
+    @staticmethod
+    def compile_loader(klass):
+        namespace = {'class_name': klass.__name__}
+        lines = ['def load(self, jsonobj):',
+                 '    try:']
+        for i, (name, decode) in enumerate(klass.__bzdecoders__):
+            namespace['decode_%d' % i] = decode
+            lines.append('        self.%s = decode_%d(jsonobj[%s])' %
+                         (name, i, repr(name)))
+        lines.extend(['        pass',
+                      '    except KeyError, e:',
+                      '        raise KeyError("key \'%s\' not found in JSON "',
+                      '                       "%s object" % (e.args[0],',
+                      '                                      class_name))'])
+        exec '\n'.join(lines) in namespace
+        return namespace['load']
 
 class BugzillaObject(object):
+    """
+    If the BugzillaApi's 'lazy_decoding' attribute is True, objects
+    keep the JSON object they're made from and only decode each of
+    their properties, and build each of their __bzderived__ slots,
+    the first time it's used.
+
+    >>> bzapi = MockBugzillaApi({'lazy_decoding': True})
+    >>> bzapi.users.get = Mock('bzapi.users.get')
+    >>> a = Attachment(TEST_ATTACHMENT_WITHOUT_DATA, bzapi)
+    >>> a.id
+    438797
+    >>> a.attacher
+    Called bzapi.users.get(u'avarma', {u'name': u'avarma'})
+    >>> a.attacher
+    >>> a = Attachment({'id': '1'}, bzapi)
+    >>> a.description
+    Traceback (most recent call last):
+    ...
+    KeyError: "key 'description' not found in JSON Attachment object"
+
+    Objects fetched with a projection of their fields are 'partial',
+    and are decoded lazily too. Using a field they weren't loaded with
+    fetches the whole object:
+
+    >>> bzapi = MockBugzillaApi()
+    >>> bzapi.request.mock_returns = {'id': '558680',
+    ...                               'summary': 'Here is a summary'}
+    >>> bug = Bug.fetch(bzapi, 558680, include_fields=['summary'])
+    Called bzapi.request(
+        'GET',
+        '/bug/558680',
+        query_args={'include_fields': 'id,summary'})
+    >>> sorted(bug.bzfields), bug.summary
+    (['id', 'summary'], u'Here is a summary')
+    >>> bzapi.request.mock_returns = TEST_BUG
+    >>> bug.attachments
+    Called bzapi.request('GET', '/bug/558680')
+    [<Attachment 438381 - u'here is a description'>]
+    >>> bug.bzfields is None
+    True
+    """
+
+    __metaclass__ = BugzillaObjectType
+    __slots__ = ('bzapi', '__weakref__', '__bzjson', '__bzpartial')
     __bzprops__ = {}
+    __bzkey__ = 'id'
+
+    # Names of string properties whose values repeat a lot, and are
+    # worth sharing between objects.
+    __bzintern__ = ()
 
-    def __init__(self, jsonobj, bzapi):
-        self._set_bzprops(jsonobj)
+    # Names of slots, besides the __bzprops__, whose values are built
+    # from the JSON object by a _decode_<name>() method.
+    __bzderived__ = ()
+
+    def __init__(self, jsonobj, bzapi, partial=False):
         self.bzapi = bzapi
+        self.__bzpartial = partial
+        if partial or getattr(bzapi, 'lazy_decoding', False) is True:
+            self.__bzjson = jsonobj
+        else:
+            self.__bzjson = None
+            self._set_bzprops(jsonobj)
+            for name in self.__bzderived__:
+                setattr(self, name,
+                        getattr(self, '_decode_' + name)(jsonobj))
+
+    def __getattr__(self, name):
+        # This is only called for slots that haven't been set, which
+        # for lazily decoded objects means ones not yet decoded. Objects
+        # made without __init__(), as unpickling does, may not have
+        # their JSON slot set either, and reading it normally would
+        # call this again.
+        try:
+            jsonobj = object.__getattribute__(self, '_BugzillaObject__bzjson')
+        except AttributeError:
+            raise AttributeError(name)
+        if jsonobj is None:
+            raise AttributeError(name)
+        if (name not in jsonobj and self.__bzpartial and
+            (name in self.__bzdecodermap__ or name in self.__bzderived__)):
+            self.__complete()
+            return getattr(self, name)
+        if name in self.__bzdecodermap__:
+            if name not in jsonobj:
+                raise KeyError("key '%s' not found in JSON %s object" %
+                               (name, self.__class__.__name__))
+            value = self.__bzdecodermap__[name](jsonobj[name])
+        elif name in self.__bzderived__:
+            value = getattr(self, '_decode_' + name)(jsonobj)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def __complete(self):
+        # Fetches the whole of a partial object and takes every field
+        # from it.
+        full = self.fetch_metadata(self.bzapi,
+                                   getattr(self, self.__bzkey__))
+        for name in list(self.__bzdecodermap__) + list(self.__bzderived__):
+            setattr(self, name, getattr(full, name))
+        self.__bzjson = None
+        self.__bzpartial = False
+
+    @property
+    def bzfields(self):
+        """
+        The names of the fields a partial object was loaded with, or
+        None if it's been loaded in full.
+        """
+
+        if not self.__bzpartial:
+            return None
+        return frozenset(self.__bzjson)
 
     def _set_bzprops(self, jsonobj):
-        for name, proptype in self.__bzprops__.items():
-            if name not in jsonobj:
-                raise KeyError("key '%s' not found in JSON "
-                               "%s object" % (name,
-                                              self.__class__.__name__))
-            if proptype == bool:
-                if isinstance(jsonobj[name], bool):
-                    setattr(self, name, jsonobj[name])
-                elif jsonobj[name] == '0':
-                    setattr(self, name, False)
-                elif jsonobj[name] == '1':
-                    setattr(self, name, True)
-                else:
-                    raise ValueError('bad boolean value: %s' %
-                                     repr(jsonobj[name]))
-            elif proptype in [int, unicode, str]:
-                setattr(self, name, proptype(jsonobj[name]))
-            elif proptype == datetime.datetime:
-                setattr(self, name,
-                        iso8601_to_datetime(jsonobj[name]))
-            else:
-                raise ValueError("bad proptype for '%s': %s" %
-                                 name, repr(proptype))
+        self.__bzloader__(self, jsonobj)
+
+    @classmethod
+    def fetch_metadata(klass, bzapi, key):
+        """
+        Fetches the whole object with the given key, apart from any
+        bulky contents that have their own accessors. This is what
+        partial objects are completed with.
+        """
+
+        return klass.fetch(bzapi, key)
+
+    @classmethod
+    def fetch_many(klass, bzapi, keys, include_fields=None,
+                   exclude_fields=None):
+        """
+        Fetches the objects with the given keys. Classes whose API can
+        fetch several objects at once override this; by default, each
+        object is fetched on its own.
+
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = TEST_ATTACHMENT_WITH_DATA
+        >>> bzapi.attachments.get_many([438797])
+        Called bzapi.request(
+            'GET',
+            '/attachment/438797',
+            query_args={'attachmentdata': '1'})
+        [<Attachment 438797 - u'test upload'>]
+        """
+
+        return [klass.fetch(bzapi, key, include_fields, exclude_fields)
+                for key in keys]
+
+    @classmethod
+    def projection(klass, include_fields=None, exclude_fields=None):
+        """
+        Returns the query arguments that ask the API for only some of
+        the fields of objects of this class. Fields may be given as
+        lists or as comma-separated strings. The class' key is always
+        included.
+
+        >>> Bug.projection(include_fields='summary')
+        {'include_fields': 'id,summary'}
+        >>> Bug.projection(exclude_fields=['comments', 'history'])
+        {'exclude_fields': 'comments,history'}
+        >>> Bug.projection()
+        {}
+        """
+
+        query_args = {}
+        if include_fields:
+            if isinstance(include_fields, basestring):
+                include_fields = include_fields.split(',')
+            fields = [klass.__bzkey__]
+            fields.extend([field for field in include_fields
+                           if field != klass.__bzkey__])
+            query_args['include_fields'] = ','.join(fields)
+        if exclude_fields:
+            if not isinstance(exclude_fields, basestring):
+                exclude_fields = ','.join(exclude_fields)
+            query_args['exclude_fields'] = exclude_fields
+        return query_args
+
+    @classmethod
+    def decode_many(klass, jsonobjs, bzapi, partial=False):
+        """
+        Returns a list of objects decoded from the given JSON objects,
+        like calling the class on each of them. The class' loader, its
+        derived decoders and whether to decode lazily are looked up
+        once for the whole list, rather than once per object. Classes
+        with their own __init__() are still called on each object.
+
+        >>> [bug.id for bug in Bug.decode_many(
+        ...   [TEST_BUG, TEST_BUG_NO_ATTACHMENTS], MockBugzillaApi()
+        ... )]
+        [558680, 558681]
+        """
+
+        if (getattr(klass.__init__, 'im_func', None) is not
+            BugzillaObject.__init__.im_func):
+            return [klass(jsonobj, bzapi, partial) for jsonobj in jsonobjs]
+        new = klass.__new__
+        set_bzapi = BugzillaObject.bzapi.__set__
+        set_json = BugzillaObject.__bzjson.__set__
+        set_partial = BugzillaObject.__bzpartial.__set__
+        objs = []
+        if partial or getattr(bzapi, 'lazy_decoding', False) is True:
+            for jsonobj in jsonobjs:
+                obj = new(klass)
+                set_bzapi(obj, bzapi)
+                set_partial(obj, partial)
+                set_json(obj, jsonobj)
+                objs.append(obj)
+            return objs
+        loader = klass.__bzloader__
+        derived = [(name, getattr(klass, '_decode_' + name))
+                   for name in klass.__bzderived__]
+        for jsonobj in jsonobjs:
+            obj = new(klass)
+            set_bzapi(obj, bzapi)
+            set_partial(obj, False)
+            set_json(obj, None)
+            loader(obj, jsonobj)
+            for name, decode in derived:
+                setattr(obj, name, decode(obj, jsonobj))
+            objs.append(obj)
+        return objs
+
+    @classmethod
+    def fetch_by_key(klass, bzapi, keys, include_fields=None,
+                     exclude_fields=None):
+        """
+        Returns a dict mapping each of the given keys that exists to
+        its object, fetched with the class' fetch_many() method.
+        """
+
+        return dict([(getattr(obj, klass.__bzkey__), obj)
+                     for obj in klass.fetch_many(bzapi, keys,
+                                                 include_fields,
+                                                 exclude_fields)])
+
+class PendingResult(object):
+    """
+    The eventual outcome of a call that some thread is busy making.
+    Other threads interested in the same outcome can wait on it
+    instead of making the call themselves.
+
+    >>> result = PendingResult()
+    >>> result.set(5)
+    >>> result.get()
+    5
+    >>> result = PendingResult()
+    >>> try:
+    ...     raise ValueError('oops')
+    ... except ValueError:
+    ...     result.set_exception(sys.exc_info())
+    >>> result.get()
+    Traceback (most recent call last):
+    ...
+    ValueError: oops
+    """
+
+    def __init__(self):
+        self.__event = threading.Event()
+        self.__value = None
+        self.__exc_info = None
+
+    def set(self, value):
+        self.__value = value
+        self.__event.set()
+
+    def set_exception(self, exc_info):
+        self.__exc_info = exc_info
+        self.__event.set()
+
+    def get(self):
+        self.__event.wait()
+        if self.__exc_info is not None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__value
+
+class LruDict(object):
+    """
+    A dict that holds at most 'maxsize' items, forgetting the least
+    recently used ones to make room for new ones.
+
+    >>> d = LruDict(2)
+    >>> d['a'] = 1
+    >>> d['b'] = 2
+    >>> d.get('a')
+    1
+    >>> d['c'] = 3
+    >>> 'b' in d, 'a' in d, len(d)
+    (False, True, 2)
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.__items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def get(self, key, default=None):
+        if key not in self.__items:
+            return default
+        value = self.__items.pop(key)
+        self.__items[key] = value
+        return value
+
+    def __getitem__(self, key):
+        if key not in self.__items:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.__items.pop(key, None)
+        self.__items[key] = value
+        while len(self.__items) > self.maxsize:
+            self.__items.popitem(last=False)
+
+    def pop(self, key, *default):
+        return self.__items.pop(key, *default)
+
+    def clear(self):
+        self.__items.clear()
+
+def make_identity_map(strategy=None):
+    """
+    Returns a dict-like object for a LazyMapping to keep its objects
+    in. 'strategy' may be None or 'unbounded' to keep every object
+    forever, 'weak' to keep objects only while something else refers
+    to them, or a number of objects to keep, least recently used
+    first.
+
+    >>> make_identity_map()
+    {}
+    >>> make_identity_map('weak') # doctest: +ELLIPSIS
+    <WeakValueDictionary at ...>
+    >>> make_identity_map(100).maxsize
+    100
+    """
+
+    if strategy is None or strategy == 'unbounded':
+        return {}
+    if strategy == 'weak':
+        return weakref.WeakValueDictionary()
+    if isinstance(strategy, (int, long)) and strategy > 0:
+        return LruDict(strategy)
+    raise ValueError('unknown identity map strategy: %s' % repr(strategy))
 
 class LazyMapping(object):
-    def __init__(self, bzapi, klass, keytype):
+    """
+    A thread-safe identity map from keys to objects, which fetches
+    objects on demand. When several threads ask for the same key at
+    once, only one of them fetches it and the others wait for its
+    result.
+
+    How long objects are kept depends on the 'identity_map' strategy
+    given to make_identity_map(). An object that has been dropped from
+    the map is fetched again the next time it's asked for. Keys that
+    a server said don't exist are remembered as missing until they're
+    evicted, so asking for them again doesn't make another request.
+
+    >>> bzapi = MockBugzillaApi()
+    >>> bzapi.request.mock_returns = TEST_BUG
+    >>> bug = bzapi.bugs.get(558680)
+    Called bzapi.request('GET', '/bug/558680')
+    >>> bzapi.bugs.get(558680) is bug
+    True
+    >>> bzapi.bugs.hits, bzapi.bugs.misses
+    (1, 1)
+    >>> bzapi.bugs.evict(558680)
+    >>> bzapi.bugs.get(558680) is bug
+    Called bzapi.request('GET', '/bug/558680')
+    False
+    """
+
+    def __init__(self, bzapi, klass, keytype, batch_size=100,
+                 identity_map=None):
         self.bzapi = bzapi
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
         self.__klass = klass
         self.__keytype = keytype
-        self.__mapping = {}
+        self.__mapping = make_identity_map(identity_map)
+        self.__pending = {}
+        self.__missing = set()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__mapping)
+
+    def evict(self, name):
+        """
+        Forgets the object with the given key, if it's loaded.
+        """
+
+        with self.__lock:
+            self.__mapping.pop(self.__keytype(name), None)
+            self.__missing.discard(self.__keytype(name))
+
+    def clear(self):
+        with self.__lock:
+            self.__mapping.clear()
+            self.__missing.clear()
+
+    def is_missing(self, name):
+        """
+        Returns whether the object with the given key is known not to
+        exist.
+        """
+
+        with self.__lock:
+            return self.__keytype(name) in self.__missing
+
+    def mark_missing(self, names):
+        """
+        Remembers that the objects with the given keys don't exist.
+        """
+
+        with self.__lock:
+            self.__missing.update([self.__keytype(name) for name in names])
+
+    def __check_missing(self, names):
+        # Called just before fetching, so that names known not to
+        # exist don't cost a request. Objects that are loaded, or that
+        # are made from JSON the caller already has, are never refused.
+        with self.__lock:
+            for name in names:
+                if name in self.__missing:
+                    raise BugzillaApiError("no %s found for '%s'" %
+                                           (self.__klass.__name__, name))
+
+    def __claim(self, names):
+        """
+        Returns a dict of the given names' objects that are loaded, a
+        list of the names that aren't loaded and that the caller is
+        now responsible for loading, and a dict of PendingResults for
+        names that other threads are loading.
+        """
+
+        found = {}
+        claimed = []
+        waiting = {}
+        with self.__lock:
+            for name in names:
+                if name in found or name in waiting or name in claimed:
+                    continue
+                obj = self.__mapping.get(name)
+                if obj is not None:
+                    self.hits += 1
+                    found[name] = obj
+                elif name in self.__pending:
+                    self.hits += 1
+                    waiting[name] = self.__pending[name]
+                else:
+                    self.misses += 1
+                    self.__pending[name] = PendingResult()
+                    claimed.append(name)
+        return found, claimed, waiting
+
+    def __settle(self, name, obj):
+        with self.__lock:
+            self.__mapping[name] = obj
+            pending = self.__pending.pop(name)
+        pending.set(obj)
+
+    def __abandon(self, names, exc_info):
+        with self.__lock:
+            pendings = [self.__pending.pop(name) for name in names
+                        if name in self.__pending]
+        for pending in pendings:
+            pending.set_exception(exc_info)
+
+    def __get_mirrored_json(self, name):
+        if self.bzapi.mirror is None:
+            return None
+        return self.bzapi.mirror.get_json(self.__klass.__name__, name)
+
+    def get(self, name, jsonobj=None, include_fields=None,
+            exclude_fields=None):
+        """
+        Returns the object with the given key, making it from
+        'jsonobj' or fetching it if it isn't loaded. A fetched object
+        is only loaded with the fields that 'include_fields' and
+        'exclude_fields' project it to, and loads the rest when
+        they're first used. If 'jsonobj' is given with a projection,
+        it's taken to have been fetched with that projection.
+        """
 
-    def get(self, name, jsonobj=None):
         name = self.__keytype(name)
-        if name not in self.__mapping:
+        found, claimed, waiting = self.__claim([name])
+        if name in found:
+            return found[name]
+        if name in waiting:
+            return waiting[name].get()
+        try:
+            partial = False
             if jsonobj:
-                obj = self.__klass(jsonobj, self.bzapi)
+                partial = bool(include_fields or exclude_fields)
             else:
-                obj = self.__klass.fetch(self.bzapi, name)
-            self.__mapping[name] = obj
+                jsonobj = self.__get_mirrored_json(name)
+            if jsonobj:
+                obj = self.__klass(jsonobj, self.bzapi, partial=partial)
+            else:
+                self.__check_missing([name])
+                obj = self.__klass.fetch(self.bzapi, name,
+                                         include_fields=include_fields,
+                                         exclude_fields=exclude_fields)
+        except:
+            self.__abandon(claimed, sys.exc_info())
+            raise
+        self.__settle(name, obj)
+        return obj
+
+    def get_async(self, name):
+        """
+        Like get(), but runs on the BugzillaApi's executor and returns
+        an AsyncResult whose get() method returns the object.
+        """
+
+        return self.bzapi.executor.apply_async(self.get, (name,))
+
+    def get_many(self, names, batch_size=None, include_fields=None,
+                 exclude_fields=None):
+        """
+        Returns the objects with the given names, in order. Objects
+        that aren't already loaded are fetched with one request per
+        'batch_size' names, projected like get() does.
+
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = TEST_BUG
+        >>> bzapi.bugs.get(558680)
+        Called bzapi.request('GET', '/bug/558680')
+        <Bug 558680 - u'Here is a summary'>
+        >>> bzapi.request.mock_returns = {'bugs': [TEST_BUG_NO_ATTACHMENTS]}
+        >>> bzapi.bugs.get_many(['558680', 558681, 558680])
+        Called bzapi.request('GET', '/bug', query_args={'id': '558681'})
+        [<Bug 558680 - u'Here is a summary'>,
+         <Bug 558681 - u'Here is another summary'>,
+         <Bug 558680 - u'Here is a summary'>]
+        >>> bzapi.bugs.get_many([558681])
+        [<Bug 558681 - u'Here is another summary'>]
+
+        Keys the server doesn't return anything for are remembered as
+        missing:
+
+        >>> bzapi.request.mock_returns = TEST_USER_SEARCH_RESULT
+        >>> try:
+        ...     bzapi.users.get_many([u'avarma', u'nobody'])
+        ... except BugzillaApiError, e:
+        ...     print e
+        Called bzapi.request(
+            'GET',
+            '/user',
+            query_args={'match': [u'avarma', u'nobody']})
+        no User found for 'nobody'
+        >>> bzapi.users.get_many([u'nobody'])
+        Traceback (most recent call last):
+        ...
+        BugzillaApiError: no User found for 'nobody'
+        >>> bzapi.users.get_many([u'avarma'])
+        [<User u'avarma@mozilla.com'>]
+        """
+
+        if batch_size is None:
+            batch_size = self.batch_size
+        names = [self.__keytype(name) for name in names]
+        loaded, claimed, waiting = self.__claim(names)
+
+        try:
+            unmirrored = []
+            for name in claimed:
+                jsonobj = self.__get_mirrored_json(name)
+                if jsonobj:
+                    loaded[name] = self.__klass(jsonobj, self.bzapi)
+                    self.__settle(name, loaded[name])
+                else:
+                    unmirrored.append(name)
+            self.__check_missing(unmirrored)
+
+            for i in range(0, len(unmirrored), batch_size):
+                batch = unmirrored[i:i + batch_size]
+                fetched = self.__klass.fetch_by_key(self.bzapi, batch,
+                                                    include_fields,
+                                                    exclude_fields)
+                for key, obj in fetched.items():
+                    name = self.__keytype(key)
+                    if name in batch:
+                        loaded[name] = obj
+                        self.__settle(name, obj)
+                        batch.remove(name)
+                if batch:
+                    self.mark_missing(batch)
+                    raise BugzillaApiError("no %s found for '%s'" %
+                                           (self.__klass.__name__,
+                                            batch[0]))
+        except:
+            self.__abandon(claimed, sys.exc_info())
+            raise
+
+        for name in waiting:
+            loaded[name] = waiting[name].get()
+        return [loaded[name] for name in names]
+
+class Bugs(LazyMapping):
+    def __init__(self, bzapi, batch_size=100, identity_map=None):
+        LazyMapping.__init__(self, bzapi, Bug, int, batch_size=batch_size,
+                             identity_map=identity_map)
+
+    def search(self, page_size=None, include_fields=None,
+               exclude_fields=None, stream=False, **criteria):
+        """
+        Yields the bugs that match the given search criteria, fetching
+        them 'page_size' at a time. The next page is requested while
+        the current one is being consumed, and no more than two pages
+        are held at once, so memory use doesn't grow with the number
+        of results, apart from whatever the identity map keeps. Bugs
+        that are already loaded are yielded as they are; others are
+        loaded from the search results, projected like get() does.
+
+        If 'stream' is true, each page is parsed as it arrives, with
+        iter_request(), so only one bug's JSON is held at a time, at
+        the cost of slower parsing. The pages are then requested one
+        after another.
+        """
 
-        return self.__mapping[name]
+        if page_size is None:
+            page_size = self.batch_size
+        query_args = dict(criteria)
+        query_args.update(Bug.projection(include_fields, exclude_fields))
+
+        def get_page_args(offset):
+            return dict(query_args, limit=str(page_size),
+                        offset=str(offset))
+
+        def load(jsonobj):
+            return self.get(jsonobj['id'], jsonobj,
+                            include_fields=include_fields,
+                            exclude_fields=exclude_fields)
+
+        offset = 0
+        if stream:
+            while True:
+                count = 0
+                for jsonobj in self.bzapi.iter_request('GET', '/bug', 'bugs',
+                                                       get_page_args(offset)):
+                    count += 1
+                    yield load(jsonobj)
+                if count < page_size:
+                    return
+                offset += count
+
+        def request_page(offset):
+            return self.bzapi.request_async('GET', '/bug',
+                                            get_page_args(offset))
+
+        page = request_page(offset)
+        while page is not None:
+            bugs = page.get()['bugs']
+            offset += len(bugs)
+            page = None
+            if len(bugs) == page_size:
+                page = request_page(offset)
+            for jsonobj in bugs:
+                yield load(jsonobj)
 
 class Attachments(LazyMapping):
-    def __init__(self, bzapi):
-        LazyMapping.__init__(self, bzapi, Attachment, int)
+    def __init__(self, bzapi, identity_map=None):
+        LazyMapping.__init__(self, bzapi, Attachment, int,
+                             identity_map=identity_map)
+
+    def iter_bug_attachments(self, bug_id):
+        """
+        Yields the attachments of the given bug, building each one as
+        soon as its JSON has come off the socket, so that bugs with
+        hundreds of attachments don't need their whole response in
+        memory at once. Attachments that are already loaded are
+        yielded as they are.
+        """
+
+        for jsonobj in self.bzapi.iter_request('GET',
+                                               '/bug/%d/attachment' % bug_id,
+                                               'attachments'):
+            yield self.get(jsonobj['id'], jsonobj)
 
     def post(self, bug_id, contents, filename, description,
              content_type=None, is_patch=False, is_private=False,
              is_obsolete=False, flags=None,
-             guess_mime_type=mimetypes.guess_type):
+             guess_mime_type=mimetypes.guess_type, size=None):
         """
+        Attaches 'contents' to the given bug. It may be a string or a
+        file object, which is streamed from its current position. If
+        the file can't be seeked, like a pipe, 'size' must say how
+        many bytes to read from it.
+
         >>> jsonreq = Mock('jsonreq')
         >>> jsonreq.mock_returns = {
         ...   "status": 201,
@@ -272,7 +2840,6 @@ class Attachments(LazyMapping):
             flags = []
 
         attachment = {
-            'data': base64.b64encode(contents),
             'description': description,
             'encoding': 'base64',
             'file_name': filename,
@@ -280,12 +2847,39 @@ class Attachments(LazyMapping):
             'is_obsolete': is_obsolete,
             'is_patch': is_patch,
             'is_private': is_private,
-            'size': len(contents),
             'content_type': content_type
             }
 
+        if hasattr(contents, 'read'):
+            if size is None:
+                size = get_file_size(contents)
+            attachment['size'] = size
+            body = Base64JsonBody(attachment, 'data', contents, size)
+        else:
+            attachment['data'] = base64.b64encode(contents)
+            attachment['size'] = len(contents)
+            body = attachment
+
         return self.bzapi.request('POST', '/bug/%d/attachment' % bug_id,
-                                  body=attachment)
+                                  body=body)
+
+    def post_file(self, bug_id, path, description, filename=None,
+                  **kwargs):
+        """
+        Like post(), but uploads the file at the given path, which is
+        streamed rather than read into memory. The attachment's
+        filename defaults to the file's.
+        """
+
+        if filename is None:
+            filename = os.path.basename(path)
+        fileobj = open(path, 'rb')
+        try:
+            return self.post(bug_id=bug_id, contents=fileobj,
+                             filename=filename, description=description,
+                             **kwargs)
+        finally:
+            fileobj.close()
 
 class User(BugzillaObject):
     """
@@ -297,7 +2891,7 @@ class User(BugzillaObject):
     >>> u.email
     u'avarma@mozilla.com'
 
-    >>> bzapi = Mock('bzapi')
+    >>> bzapi = MockBugzillaApi()
     >>> bzapi.request.mock_returns = TEST_USER_SEARCH_RESULT
     >>> u = User({'name': 'avarma@mozilla.com'}, bzapi)
     >>> u.real_name
@@ -306,6 +2900,29 @@ class User(BugzillaObject):
         '/user',
         query_args={'match': u'avarma@mozilla.com'})
     u'Atul Varma [:atul]'
+
+    Users whose details are fulfilled together share one request:
+
+    >>> users = [User({'name': name}, bzapi)
+    ...          for name in [u'avarma@mozilla.com', u'nobody']]
+    >>> User.fulfill_together(users)
+    >>> users[0].email
+    Called bzapi.request(
+        'GET',
+        '/user',
+        query_args={'match': [u'avarma@mozilla.com', u'nobody']})
+    u'avarma@mozilla.com'
+
+    A user the batch's results can't be paired with is looked up on
+    its own:
+
+    >>> bzapi.request.mock_returns = {'users': []}
+    >>> try:
+    ...     users[1].email
+    ... except BugzillaApiError, e:
+    ...     print e
+    Called bzapi.request('GET', '/user', query_args={'match': u'nobody'})
+    no users found for name 'nobody'
     """
 
     # TODO: This class currently assumes that the bzapi is
@@ -314,17 +2931,106 @@ class User(BugzillaObject):
     __bzprops__ = {
         'name': unicode
         }
+    __bzkey__ = 'name'
+    __bzintern__ = ('name',)
+    __bzslots__ = ('__email', '__real_name', '__peers')
 
-    def __init__(self, jsonobj, bzapi):
-        BugzillaObject.__init__(self, jsonobj, bzapi)
+    def __init__(self, jsonobj, bzapi, partial=False):
+        BugzillaObject.__init__(self, jsonobj, bzapi, partial)
         self.__email = jsonobj.get('email')
         self.__real_name = jsonobj.get('real_name')
+        self.__peers = None
 
-    def __fulfill(self):
-        user = self.__get_user(self.bzapi, self.name)
+    def __is_fulfilled(self):
+        return self.__email is not None and self.__real_name is not None
+
+    def __set_details(self, user):
         self.__email = user['email']
         self.__real_name = user['real_name']
 
+    def __live_peers(self):
+        if self.__peers is None:
+            return []
+        peers = [ref() for ref in self.__peers]
+        return [peer for peer in peers if peer is not None]
+
+    def __fulfill(self):
+        peers = self.__live_peers()
+        if peers:
+            for peer in peers:
+                peer.__peers = None
+            self.fulfill_many(self.bzapi, peers)
+            if self.__is_fulfilled():
+                return
+        # The batch couldn't tell which of the users it found this one
+        # is, so ask the server about it alone.
+        self.__set_details(self.__get_user(self.bzapi, self.name))
+
+    @classmethod
+    def fulfill_together(klass, users):
+        """
+        Makes the first use of any of the given users' details load
+        the details of all of them, with a single request. Users that
+        were already linked to others, by another bug, stay linked to
+        them too. Users only refer to each other weakly, and forget
+        each other once their details have been loaded.
+        """
+
+        peers = {}
+        for user in users:
+            if not user.__is_fulfilled():
+                for peer in [user] + user.__live_peers():
+                    peers[id(peer)] = peer
+        if len(peers) < 2:
+            return
+        refs = [weakref.ref(peer) for peer in peers.values()]
+        for peer in peers.values():
+            peer.__peers = refs
+
+    @classmethod
+    def fulfill_many(klass, bzapi, users):
+        """
+        Loads the email and real name of each of the given users that
+        doesn't have them yet, with one request per batch of names.
+        If the server finds no users at all for a batch, its names are
+        remembered as missing by the BugzillaApi's users mapping.
+        Users that can't be told apart in a batch's results are left
+        as they are.
+        """
+
+        unfulfilled = {}
+        for user in users:
+            if not (user.__is_fulfilled() or
+                    bzapi.users.is_missing(user.name)):
+                unfulfilled.setdefault(user.name, []).append(user)
+        names = sorted(unfulfilled)
+        batch_size = bzapi.users.batch_size
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i + batch_size]
+            found = klass.__get_users(bzapi, batch)
+            if not found:
+                bzapi.users.mark_missing(batch)
+                continue
+            matches = klass.__pair_users(batch, found)
+            for name in batch:
+                if len(matches[name]) == 1:
+                    for user in unfulfilled[name]:
+                        user.__set_details(matches[name][0])
+
+    def fulfill_async(self, callback=None):
+        """
+        Loads the user's email and real name on the BugzillaApi's
+        executor. Returns an AsyncResult whose get() method returns
+        the user.
+        """
+
+        def fulfill():
+            if self.__email is None or self.__real_name is None:
+                self.__fulfill()
+            return self
+
+        return self.bzapi.executor.apply_async(fulfill, callback=callback)
+
     @property
     def email(self):
         if self.__email is None:
@@ -340,10 +3046,11 @@ class User(BugzillaObject):
     def __repr__(self):
         return '<User %s>' % repr(self.name)
 
-    @staticmethod
-    def __get_user(bzapi, name):
-        response = bzapi.request('GET', '/user',
-                                 query_args={'match': name})
+    @classmethod
+    def __get_user(klass, bzapi, name, projection=None):
+        query_args = {'match': name}
+        query_args.update(projection or {})
+        response = bzapi.request('GET', '/user', query_args=query_args)
         users = response['users']
         if len(users) > 1:
             raise BugzillaApiError("more than one user found for "
@@ -353,8 +3060,34 @@ class User(BugzillaObject):
                                    "name '%s'" % name)
         return users[0]
 
+    @staticmethod
+    def __get_users(bzapi, names, projection=None):
+        # Returns the users the server found for any of the given
+        # names.
+        query_args = {'match': list(names)}
+        query_args.update(projection or {})
+        response = bzapi.request('GET', '/user', query_args=query_args)
+        return response['users']
+
+    @staticmethod
+    def __pair_users(names, users):
+        # Returns a dict mapping each of the given names to a list of
+        # the users it may refer to. The server matches names loosely
+        # and for all the names at once, so a name is taken to refer
+        # to the users with that name, ignoring case, or failing that,
+        # to those whose name it is the part before the '@' of.
+        exact = {}
+        abbreviated = {}
+        for user in users:
+            name = user['name'].lower()
+            exact.setdefault(name, []).append(user)
+            abbreviated.setdefault(name.split('@')[0], []).append(user)
+        return dict([(name, exact.get(name.lower()) or
+                      abbreviated.get(name.lower(), []))
+                     for name in names])
+
     @classmethod
-    def fetch(klass, bzapi, name):
+    def fetch(klass, bzapi, name, include_fields=None, exclude_fields=None):
         """
         >>> bzapi = Mock('bzapi')
         >>> bzapi.request.mock_returns = TEST_USER_SEARCH_RESULT
@@ -364,7 +3097,40 @@ class User(BugzillaObject):
         <User u'avarma@mozilla.com'>
         """
 
-        return klass(klass.__get_user(bzapi, name), bzapi)
+        projection = klass.projection(include_fields, exclude_fields)
+        return klass(klass.__get_user(bzapi, name, projection), bzapi,
+                     partial=bool(projection))
+
+    @classmethod
+    def fetch_many(klass, bzapi, names, include_fields=None,
+                   exclude_fields=None):
+        """
+        Returns the users with the given names that exist, fetched
+        with a single request.
+
+        >>> bzapi = Mock('bzapi')
+        >>> bzapi.request.mock_returns = TEST_USER_SEARCH_RESULT
+        >>> User.fetch_many(bzapi, [u'avarma', u'nobody'])
+        Called bzapi.request(
+            'GET',
+            '/user',
+            query_args={'match': [u'avarma', u'nobody']})
+        [<User u'avarma@mozilla.com'>]
+        """
+
+        users = klass.fetch_by_key(bzapi, names, include_fields,
+                                   exclude_fields)
+        return [users[name] for name in names if name in users]
+
+    @classmethod
+    def fetch_by_key(klass, bzapi, names, include_fields=None,
+                     exclude_fields=None):
+        projection = klass.projection(include_fields, exclude_fields)
+        matches = klass.__pair_users(names, klass.__get_users(bzapi, names,
+                                                              projection))
+        return dict([(name, klass(matches[name][0], bzapi,
+                                  partial=bool(projection)))
+                     for name in names if len(matches[name]) == 1])
 
 class Attachment(BugzillaObject):
     """
@@ -389,15 +3155,25 @@ class Attachment(BugzillaObject):
         'is_patch': bool,
         'is_obsolete': bool
         }
+    __bzintern__ = ('content_type',)
+    __bzslots__ = ('attacher',)
+    __bzderived__ = ('attacher',)
 
-    def __init__(self, jsonobj, bzapi):
-        BugzillaObject.__init__(self, jsonobj, bzapi)
+    def __init__(self, jsonobj, bzapi, partial=False):
+        data = None
         if 'data' in jsonobj:
-            self.__data = self.__decode_data(jsonobj)
-        else:
-            self.__data = None
-        self.attacher = self.bzapi.users.get(jsonobj['attacher']['name'],
-                                             jsonobj['attacher'])
+            data = self.__decode_data(jsonobj)
+            # Lazily decoded attachments keep their JSON object, which
+            # shouldn't hold on to a second, encoded copy of the data.
+            jsonobj = dict(jsonobj)
+            del jsonobj['data']
+        BugzillaObject.__init__(self, jsonobj, bzapi, partial)
+        if data is not None:
+            self.bzapi.attachment_data.put(self.id, data)
+
+    def _decode_attacher(self, jsonobj):
+        return self.bzapi.users.get(jsonobj['attacher']['name'],
+                                    jsonobj['attacher'])
 
     @property
     def bug(self):
@@ -405,27 +3181,117 @@ class Attachment(BugzillaObject):
 
     @property
     def data(self):
-        if self.__data is None:
+        data = self.bzapi.attachment_data.get(self.id)
+        if data is None:
             jsonobj = self.__get_full_attachment(self.bzapi, self.id)
-            self.__data = self.__decode_data(jsonobj)
-        return self.__data
+            data = self.__decode_data(jsonobj)
+            self.bzapi.attachment_data.put(self.id, data)
+        return data
 
-    def __decode_data(self, jsonobj):
-        if jsonobj['encoding'] != 'base64':
+    def iter_data(self, chunk_size=65536):
+        """
+        Yields the attachment's data in pieces, downloading and
+        decoding it as it goes, so that the whole thing is never in
+        memory at once. The data isn't kept on the attachment.
+
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = StringIO.StringIO(
+        ...   json.dumps(TEST_ATTACHMENT_WITH_DATA)
+        ... )
+        >>> a = Attachment(TEST_ATTACHMENT_WITHOUT_DATA, bzapi)
+        >>> list(a.iter_data(chunk_size=4))
+        Called bzapi.request(
+            'GET',
+            '/attachment/438797',
+            query_args={'attachmentdata': '1'},
+            stream=True)
+        ['tes', 'tin', 'g!']
+        """
+
+        data = self.bzapi.attachment_data.get(self.id)
+        if data is not None:
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+            return
+
+        stream = self.bzapi.request('GET', '/attachment/%d' % self.id,
+                                    query_args={'attachmentdata': '1'},
+                                    stream=True)
+        encoding = None
+        seen_data = False
+        try:
+            reader = JsonStreamReader(stream, chunk_size)
+            for key in reader.iter_members():
+                if key == 'error':
+                    error = reader.read_value()
+                    if error:
+                        raise BugzillaApiError(error)
+                elif key == 'encoding':
+                    encoding = reader.read_value()
+                    self.__check_encoding(encoding)
+                elif key == 'data':
+                    seen_data = True
+                    decoder = Base64Decoder()
+                    for text in reader.iter_string():
+                        data = decoder.feed(text)
+                        if data:
+                            yield data
+                    decoder.finish()
+        finally:
+            stream.close()
+        if not seen_data:
+            raise BugzillaApiError("no data found for attachment %d" %
+                                   self.id)
+        # The encoding may only have come after the data.
+        self.__check_encoding(encoding)
+
+    def save_to(self, path_or_fileobj, chunk_size=65536):
+        """
+        Streams the attachment's data to the given file or path and
+        returns the number of bytes written. A path is only written to
+        once the whole download has succeeded.
+        """
+
+        if isinstance(path_or_fileobj, basestring):
+            with open_atomically(path_or_fileobj) as fileobj:
+                return self.save_to(fileobj, chunk_size)
+        size = 0
+        for data in self.iter_data(chunk_size):
+            path_or_fileobj.write(data)
+            size += len(data)
+        return size
+
+    def fetch_data_async(self, callback=None):
+        """
+        Downloads the attachment's data on the BugzillaApi's executor.
+        Returns an AsyncResult whose get() method returns the data.
+        """
+
+        return self.bzapi.executor.apply_async(lambda: self.data,
+                                               callback=callback)
+
+    def __check_encoding(self, encoding):
+        if encoding != 'base64':
             raise NotImplementedError("unrecognized encoding: %s" %
-                                      jsonobj['encoding'])
+                                      encoding)
+
+    def __decode_data(self, jsonobj):
+        self.__check_encoding(jsonobj['encoding'])
         return base64.b64decode(jsonobj['data'])
 
     def __repr__(self):
         return '<Attachment %d - %s>' % (self.id, repr(self.description))
 
     @staticmethod
-    def __get_full_attachment(bzapi, attach_id):
+    def __get_full_attachment(bzapi, attach_id, projection=None):
+        query_args = {'attachmentdata': '1'}
+        query_args.update(projection or {})
         return bzapi.request('GET', '/attachment/%d' % attach_id,
-                             query_args={'attachmentdata': '1'})
+                             query_args=query_args)
 
     @classmethod
-    def fetch(klass, bzapi, attach_id):
+    def fetch(klass, bzapi, attach_id, include_fields=None,
+              exclude_fields=None):
         """
         >>> bzapi = MockBugzillaApi()
         >>> bzapi.request.mock_returns = TEST_ATTACHMENT_WITH_DATA
@@ -437,7 +3303,31 @@ class Attachment(BugzillaObject):
         <Attachment 438797 - u'test upload'>
         """
 
-        return klass(klass.__get_full_attachment(bzapi, attach_id),
+        projection = klass.projection(include_fields, exclude_fields)
+        return klass(klass.__get_full_attachment(bzapi, attach_id,
+                                                 projection),
+                     bzapi, partial=bool(projection))
+
+    @classmethod
+    def fetch_metadata(klass, bzapi, attach_id):
+        """
+        Fetches the attachment without its data.
+
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = {'id': '438797', 'is_patch': '0'}
+        >>> a = Attachment.fetch(bzapi, 438797, include_fields='is_patch')
+        Called bzapi.request(
+            'GET',
+            '/attachment/438797',
+            query_args={'attachmentdata': '1',
+                        'include_fields': 'id,is_patch'})
+        >>> bzapi.request.mock_returns = TEST_ATTACHMENT_WITHOUT_DATA
+        >>> a.description
+        Called bzapi.request('GET', '/attachment/438797')
+        u'test upload'
+        """
+
+        return klass(bzapi.request('GET', '/attachment/%d' % attach_id),
                      bzapi)
 
 class Bug(BugzillaObject):
@@ -453,18 +3343,22 @@ class Bug(BugzillaObject):
         'id': int,
         'summary': unicode
         }
+    __bzslots__ = ('attachments',)
+    __bzderived__ = ('attachments',)
 
-    def __init__(self, jsonobj, bzapi):
-        BugzillaObject.__init__(self, jsonobj, bzapi)
-        self.attachments = [bzapi.attachments.get(attach['id'], attach)
-                            for attach in jsonobj.get('attachments',
-                                                      [])]
+    def _decode_attachments(self, jsonobj):
+        attachments = [self.bzapi.attachments.get(attach['id'], attach)
+                       for attach in jsonobj.get('attachments', [])]
+        User.fulfill_together([attachment.attacher
+                               for attachment in attachments])
+        return attachments
 
     def __repr__(self):
         return '<Bug %d - %s>' % (self.id, repr(self.summary))
 
     @classmethod
-    def fetch(klass, bzapi, bug_id):
+    def fetch(klass, bzapi, bug_id, include_fields=None,
+              exclude_fields=None):
         """
         >>> bzapi = MockBugzillaApi()
         >>> bzapi.request.mock_returns = TEST_BUG
@@ -473,4 +3367,38 @@ class Bug(BugzillaObject):
         <Bug 558680 - u'Here is a summary'>
         """
 
+        projection = klass.projection(include_fields, exclude_fields)
+        if projection:
+            return klass(bzapi.request('GET', '/bug/%d' % bug_id,
+                                       query_args=projection),
+                         bzapi, partial=True)
         return klass(bzapi.request('GET', '/bug/%d' % bug_id), bzapi)
+
+    @classmethod
+    def fetch_many(klass, bzapi, bug_ids, include_fields=None,
+                   exclude_fields=None, stream=False):
+        """
+        >>> bzapi = MockBugzillaApi()
+        >>> bzapi.request.mock_returns = {
+        ...   'bugs': [TEST_BUG, TEST_BUG_NO_ATTACHMENTS]
+        ... }
+        >>> Bug.fetch_many(bzapi, [558680, 558681])
+        Called bzapi.request('GET', '/bug',
+                             query_args={'id': '558680,558681'})
+        [<Bug 558680 - u'Here is a summary'>,
+         <Bug 558681 - u'Here is another summary'>]
+        """
+
+        ids = ','.join([str(bug_id) for bug_id in bug_ids])
+        projection = klass.projection(include_fields, exclude_fields)
+        query_args = {'id': ids}
+        query_args.update(projection)
+        if stream:
+            # Build each bug as soon as it's been parsed, instead of
+            # holding the whole response and its parse tree at once.
+            jsonobjs = bzapi.iter_request('GET', '/bug', 'bugs',
+                                          query_args=query_args)
+        else:
+            response = bzapi.request('GET', '/bug', query_args=query_args)
+            jsonobjs = response['bugs']
+        return klass.decode_many(jsonobjs, bzapi, partial=bool(projection))
@@ -1,6 +1,8 @@
 #! /usr/bin/env python
 
+import os
 import sys
+import time
 import datetime
 import base64
 import optparse
@@ -74,24 +76,177 @@ def make_patch(patch, real_name, email, bug_id, summary):
     header = make_patch_header(real_name, email, bug_id, summary)
     return '\n'.join([header, '', patch])
 
-def get_patch_from_attachment(attachment):
+def get_patch_from_attachment(attachment, bug=None):
+    if bug is None:
+        bug = attachment.bug
     return make_patch(patch=attachment.data,
                       real_name=attachment.attacher.real_name,
                       email=attachment.attacher.email,
-                      bug_id=attachment.bug.id,
-                      summary=attachment.bug.summary)
+                      bug_id=bug.id,
+                      summary=bug.summary)
+
+def newest(attachments):
+    """
+    Returns the most recently created of the given attachments, or
+    None if there are none.
+    """
+
+    if not attachments:
+        return None
+    return max(attachments, key=lambda a: (a.creation_time, a.id))
+
+def find_latest_patch(bug):
+    """
+    Returns the bug's most recently created patch that isn't
+    obsolete, or None if it has none.
+    """
+
+    return newest([patch for patch in bug.attachments
+                   if patch.is_patch and not patch.is_obsolete])
 
 def get_patch(bug):
-    def cmp_lastcreated(a, b):
-        return cmp(a.creation_time, b.creation_time)
+    most_recent_patch = find_latest_patch(bug)
+    if most_recent_patch is None:
+        raise IndexError('bug %d has no patches' % bug.id)
+
+    return get_patch_from_attachment(most_recent_patch, bug)
+
+def get_latest_patch(bzapi, bug_id):
+    """
+    Returns the latest patch of the given bug, with its HG header.
+    Only the bug's summary and attachment metadata are asked for,
+    and only the chosen patch's contents are downloaded, so this
+    takes two requests when the attacher's details come with the
+    bug, as they do for logged-in users.
+
+    >>> bzapi = MockBugzillaApi()
+    >>> bzapi.request.mock_returns = TEST_BUG
+    >>> bzapi.attachment_data.put(438381, 'o hai')
+    >>> bzapi.users.get(u'asqueella', {'name': u'asqueella',
+    ...                                'email': u'asqueella@gmail.com',
+    ...                                'real_name': u'Nickolay'})
+    <User u'asqueella'>
+    >>> print get_latest_patch(bzapi, 558680)
+    Called bzapi.request(
+        'GET',
+        '/bug/558680',
+        query_args={'include_fields': 'id,summary,attachments'})
+    # HG changeset patch
+    # User Nickolay <asqueella@gmail.com>
+    Bug 558680 - Here is a summary
+    <BLANKLINE>
+    o hai
+    """
 
-    patches = [patch for patch in bug.attachments
-               if patch.is_patch and not patch.is_obsolete]
-    patches.sort(cmp_lastcreated)
+    query_args = bugzilla.Bug.projection(['summary', 'attachments'])
+    response = bzapi.request('GET', '/bug/%d' % bug_id,
+                             query_args=query_args)
+    # The API can't filter attachments by kind, so skip the ones that
+    # aren't current patches before any models are built. This is why
+    # the bug itself isn't loaded through bzapi.bugs.
+    patches = [bzapi.attachments.get(attach['id'], attach)
+               for attach in response.get('attachments', [])
+               if bugzilla.decode_bool(attach['is_patch']) and
+               not bugzilla.decode_bool(attach['is_obsolete'])]
+    most_recent_patch = newest(patches)
+    if most_recent_patch is None:
+        raise IndexError('bug %d has no patches' % bug_id)
 
-    most_recent_patch = patches[-1]
+    return make_patch(patch=most_recent_patch.data,
+                      real_name=most_recent_patch.attacher.real_name,
+                      email=most_recent_patch.attacher.email,
+                      bug_id=bug_id,
+                      summary=response['summary'])
 
-    return get_patch_from_attachment(most_recent_patch)
+def save_patches(bzapi, bug_ids, output_dir):
+    """
+    Writes the latest patch of each of the given bugs to a file
+    called bug-<id>.patch in 'output_dir'. The bugs are fetched in
+    batches, their attachers are looked up together, and the patches
+    are downloaded concurrently.
+
+    Returns a (paths, errors) tuple. 'paths' maps the id of each bug
+    that has a patch to the path it was written to, and 'errors' maps
+    the id of each bug that couldn't be loaded to the reason why.
+    """
+
+    bugs = {}
+    patches = []
+    loaded, errors = load_bugs(bzapi, bug_ids)
+    for bug in loaded:
+        bugs[bug.id] = bug
+        patch = find_latest_patch(bug)
+        if patch is not None:
+            patches.append(patch)
+    bugzilla.User.fulfill_together([patch.attacher for patch in patches])
+
+    def save(attachment):
+        path = os.path.join(output_dir, 'bug-%d.patch' % attachment.bug_id)
+        patch = get_patch_from_attachment(attachment, bugs[attachment.bug_id])
+        if isinstance(patch, unicode):
+            patch = patch.encode('utf-8')
+        bugzilla.write_file_atomically(path, patch)
+        return attachment.bug_id, path
+
+    return dict(bzapi.map(save, patches)), errors
+
+def load_bugs(bzapi, bug_ids):
+    """
+    Loads the given bugs a batch at a time, and returns a (bugs,
+    errors) tuple. A batch that fails is loaded again one bug at a
+    time, so that a bug that can't be loaded doesn't take the rest of
+    its batch with it. 'errors' maps the id of each bug that couldn't
+    be loaded to the reason why.
+    """
+
+    bugs = []
+    errors = {}
+    batch_size = bzapi.bugs.batch_size
+    for i in range(0, len(bug_ids), batch_size):
+        batch = bug_ids[i:i + batch_size]
+        try:
+            bugs.extend(bzapi.bugs.get_many(batch))
+        except bugzilla.BugzillaApiError:
+            for bug_id in batch:
+                try:
+                    bugs.append(bzapi.bugs.get(bug_id))
+                except bugzilla.BugzillaApiError, e:
+                    errors[bug_id] = str(e)
+    return bugs, errors
+
+def get_many(bzapi, args):
+    parser = optparse.OptionParser(
+        usage='%prog get-many [options] [<bug-id> ...]',
+        description='Saves the latest patch of each of the given bugs, '
+                    'or of the bugs whose ids are read from stdin.'
+        )
+    parser.add_option('-o', '--output-dir', default='.',
+                      help='directory to write the patches to '
+                           '[default: %default]')
+    options, args = parser.parse_args(args)
+    if not args:
+        args = sys.stdin.read().split()
+    try:
+        bug_ids = [int(arg) for arg in args]
+    except ValueError, e:
+        parser.error('not a valid bug id: %s' % e)
+
+    bugzilla.makedirs(options.output_dir)
+    start = time.time()
+    paths, errors = save_patches(bzapi, bug_ids, options.output_dir)
+    elapsed = time.time() - start
+
+    for bug_id in bug_ids:
+        if bug_id in paths:
+            print paths[bug_id]
+        elif bug_id in errors:
+            sys.stderr.write('bug %d could not be loaded: %s\n' %
+                             (bug_id, errors[bug_id]))
+        else:
+            sys.stderr.write('bug %d has no patches\n' % bug_id)
+    sys.stderr.write('saved %d patches for %d bugs in %.2fs '
+                     'with %d requests\n' % (len(paths), len(set(bug_ids)),
+                                             elapsed, bzapi.request_count))
 
 def post_patch(bzapi, bug, patch, description, flags=None):
     """
@@ -147,9 +302,19 @@ def post_pullreq(bzapi, bug, url, flags=None):
                            content_type="text/html")
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['get-many']:
+        bzapi = bugzilla.BugzillaApi()
+        try:
+            get_many(bzapi, sys.argv[2:])
+        finally:
+            bzapi.close()
+        sys.exit(0)
+
     if len(sys.argv) < 3:
         print ("usage: %s <post|get|pullreq> <bug-id> [desc] [url] "
                "[review requestee]" % sys.argv[0])
+        print ("       %s get-many [-o <output-dir>] [<bug-id> ...]" %
+               sys.argv[0])
         sys.exit(1)
 
     cmd = sys.argv[1]
@@ -180,18 +345,23 @@ if __name__ == '__main__':
                   "status": "?"}]
 
     bzapi = bugzilla.BugzillaApi()
-    bug = bzapi.bugs.get(bug_id)
-
-    if cmd == 'get':
-        sys.stdout.write(get_patch(bug))
-    elif cmd == 'post':
-        post_patch(bzapi=bzapi,
-                   bug=bug,
-                   patch=sys.stdin.read(),
-                   description=sys.argv[3],
-                   flags=flags)
-    elif cmd == 'pullreq':
-        post_pullreq(bzapi=bzapi,
-                     bug=bug,
-                     url=sys.argv[3],
-                     flags=flags)
+    try:
+        if cmd == 'get':
+            sys.stdout.write(get_latest_patch(bzapi, bug_id))
+            sys.exit(0)
+
+        bug = bzapi.bugs.get(bug_id)
+
+        if cmd == 'post':
+            post_patch(bzapi=bzapi,
+                       bug=bug,
+                       patch=sys.stdin.read(),
+                       description=sys.argv[3],
+                       flags=flags)
+        elif cmd == 'pullreq':
+            post_pullreq(bzapi=bzapi,
+                         bug=bug,
+                         url=sys.argv[3],
+                         flags=flags)
+    finally:
+        bzapi.close()
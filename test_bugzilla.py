@@ -1,9 +1,18 @@
 import os
+import pickle
 import doctest
 import unittest
+import time
+import shutil
+import tempfile
+import threading
+import StringIO
+import SocketServer
+import BaseHTTPServer
 
 from minimock import Mock
 import bugzilla
+import bzpatch
 
 TEST_CFG_WITH_LOGIN = {'api_server': 'http://foo/latest',
                        'username': 'bar',
@@ -74,6 +83,92 @@ class MockBugzillaApi(bugzilla.BugzillaApi):
                                       getpass=Mock('getpass'))
         self.request = Mock('bzapi.request')
 
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        path = self.path.split('?')[0]
+        if path in self.server.responses:
+            self.respond(200, self.server.responses[path])
+        else:
+            self.respond(404, {'error': 1, 'message': 'not found'})
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        self.server.posted.append(bugzilla.json.loads(body))
+        self.respond(201, {'ref': 'http://foo/latest/attachment/1'})
+
+    def respond(self, status, obj):
+        body = bugzilla.json.dumps(obj)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            # Hang up without telling the client, like a server
+            # reaping idle keep-alive connections would.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.responses = responses
+        self.requests = []
+        self.posted = []
+        self.connections = 0
+        self.drop_connections = False
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubServerTestCase(unittest.TestCase):
+    """
+    Runs each test against a StubServer serving responses(), with a
+    BugzillaApi pointed at it as self.bzapi.
+    """
+
+    # Extra configuration for self.bzapi.
+    config = {}
+
+    def responses(self):
+        return {}
+
+    def setUp(self):
+        self.server = StubServer(self.responses())
+        self.server.start()
+        self.bzapi = self.make_bzapi()
+
+    def tearDown(self):
+        self.bzapi.close()
+        self.server.stop()
+
+    def make_bzapi(self, **config):
+        config = dict(self.config, **config)
+        config['api_server'] = self.server.url
+        return bugzilla.BugzillaApi(config=config)
+
 DOCTEST_EXTRA_GLOBS = {
     'Mock': Mock,
     'MockBugzillaApi': MockBugzillaApi
@@ -85,6 +180,47 @@ for globname in globals().keys():
 del globname
 
 class Tests(unittest.TestCase):
+    def test_weak_identity_map(self):
+        bzapi = MockBugzillaApi({'identity_maps': {'bugs': 'weak'}})
+        bug = bzapi.bugs.get(558681, TEST_BUG_NO_ATTACHMENTS)
+        self.assertTrue(bzapi.bugs.get(558681) is bug)
+        self.assertEqual(len(bzapi.bugs), 1)
+        del bug
+        self.assertEqual(len(bzapi.bugs), 0)
+
+    def test_lru_identity_map(self):
+        bzapi = MockBugzillaApi({'identity_maps': {'bugs': 1}})
+        bzapi.bugs.get(558680, TEST_BUG)
+        bzapi.bugs.get(558681, TEST_BUG_NO_ATTACHMENTS)
+        self.assertEqual(len(bzapi.bugs), 1)
+        self.assertEqual(len(bzapi.attachments), 1)
+
+    def test_subclasses_keep_their_dict(self):
+        class AnnotatedBug(bugzilla.Bug):
+            def __init__(self, jsonobj, bzapi, partial=False):
+                bugzilla.Bug.__init__(self, jsonobj, bzapi, partial)
+                self.extra = 1
+        bug = AnnotatedBug(TEST_BUG, MockBugzillaApi())
+        self.assertEqual((bug.id, bug.extra), (558680, 1))
+
+    def test_decode_many(self):
+        jsonobjs = [TEST_BUG, TEST_BUG_NO_ATTACHMENTS]
+        for config in [{}, {'lazy_decoding': True}]:
+            bugs = bugzilla.Bug.decode_many(jsonobjs, MockBugzillaApi(config))
+            self.assertEqual([(bug.id, bug.summary, len(bug.attachments))
+                              for bug in bugs],
+                             [(558680, TEST_BUG['summary'], 1),
+                              (558681, TEST_BUG_NO_ATTACHMENTS['summary'],
+                               0)])
+        users = bugzilla.User.decode_many([TEST_USER], None)
+        self.assertEqual(users[0].email, TEST_USER['email'])
+
+    def test_pickle_round_trip(self):
+        user = pickle.loads(pickle.dumps(bugzilla.User(TEST_USER, None), 2))
+        self.assertEqual((user.name, user.email, user.real_name),
+                         (TEST_USER['name'], TEST_USER['email'],
+                          TEST_USER['real_name']))
+
     def test_bool(self):
         class Foo(bugzilla.BugzillaObject):
             __bzprops__ = {'foo': bool}
@@ -94,6 +230,634 @@ class Tests(unittest.TestCase):
         self.assertEqual(Foo({'foo': '0'}, None).foo, False)
         self.assertEqual(Foo({'foo': '1'}, None).foo, True)
 
+class JsonBlobCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_sharding(self):
+        cache = bugzilla.JsonBlobCache(self.cachedir)
+        cache['abcdef'] = {'foo': 1}
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, 'ab',
+                                                    'abcdef.json')))
+        self.assertTrue('abcdef' in cache)
+        self.assertFalse('abcdeg' in cache)
+        self.assertEqual(cache['abcdef'], {'foo': 1})
+        self.assertRaises(KeyError, lambda: cache['abcdeg'])
+
+    def test_size_is_persisted(self):
+        cache = bugzilla.JsonBlobCache(self.cachedir)
+        cache['aa'] = 'x' * 8
+        cache['bb'] = 'y' * 8
+        cache['aa'] = 'z' * 3
+        self.assertEqual(cache.size, 15)
+        self.assertEqual(bugzilla.JsonBlobCache(self.cachedir).size, 15)
+        self.assertEqual(cache.recompute_size(), 15)
+
+    def test_size_is_shared_between_instances(self):
+        first = bugzilla.JsonBlobCache(self.cachedir)
+        second = bugzilla.JsonBlobCache(self.cachedir)
+        self.assertEqual(first.size, 0)
+        self.assertEqual(second.size, 0)
+        first['aa'] = 'x' * 8
+        second['bb'] = 'y' * 8
+        first['cc'] = 'z' * 8
+        self.assertEqual(second.size, 30)
+        self.assertEqual(first.recompute_size(), 30)
+
+    def test_lru_eviction(self):
+        cache = bugzilla.JsonBlobCache(self.cachedir, max_size=25)
+        cache['aa'] = 'x' * 8
+        cache['bb'] = 'y' * 8
+        os.utime(os.path.join(self.cachedir, 'aa', 'aa.json'), (1, 1))
+        os.utime(os.path.join(self.cachedir, 'bb', 'bb.json'), (2, 2))
+        cache['cc'] = 'z' * 8
+        self.assertFalse('aa' in cache)
+        self.assertTrue('bb' in cache)
+        self.assertTrue('cc' in cache)
+        self.assertEqual(cache.size, 20)
+
+class SqliteCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cachedir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_shared_between_threads_and_instances(self):
+        cache = bugzilla.SqliteCache(self.path)
+        def write(i):
+            cache['key%d' % i] = {'i': i}
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        other = bugzilla.SqliteCache(self.path)
+        for i in range(4):
+            self.assertEqual(other['key%d' % i], {'i': i})
+
+    def test_lru_eviction(self):
+        now = [0]
+        cache = bugzilla.SqliteCache(self.path, max_size=25,
+                                     timer=lambda: now[0])
+        cache['aa'] = 'x' * 8
+        now[0] = 1
+        cache['bb'] = 'y' * 8
+        now[0] = 2
+        cache['aa']
+        now[0] = 3
+        cache['cc'] = 'z' * 8
+        self.assertTrue('aa' in cache)
+        self.assertFalse('bb' in cache)
+        self.assertTrue('cc' in cache)
+        self.assertEqual(cache.size, 20)
+
+    def test_size_is_kept_up_to_date(self):
+        cache = bugzilla.SqliteCache(self.path)
+        cache['aa'] = 'x' * 8
+        cache['bb'] = 'y' * 8
+        cache['aa'] = 'x' * 18
+        self.assertEqual(cache.size, 30)
+        del cache['bb']
+        self.assertEqual(cache.size, 20)
+        cache.evict_bug(5)
+        self.assertEqual(bugzilla.SqliteCache(self.path).size, 20)
+
+    def test_evicts_in_batches(self):
+        now = [0]
+        cache = bugzilla.SqliteCache(self.path, timer=lambda: now[0])
+        cache.EVICT_BATCH_SIZE = 2
+        for i in range(7):
+            now[0] = i
+            cache['key%d' % i] = 'x' * 8
+        cache.evict(30)
+        self.assertEqual(cache.size, 30)
+        self.assertEqual([('key%d' % i) in cache for i in range(7)],
+                         [False] * 4 + [True] * 3)
+
+class CachingJsonRequestTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.bodies = iter(['first', 'second'])
+        self.refreshed = threading.Event()
+
+    def jsonreq(self, method, url, query_args=None, body=None):
+        response = {'status': 200, 'body': self.bodies.next()}
+        if response['body'] == 'second':
+            self.refreshed.set()
+        return response
+
+    def test_stale_while_revalidate(self):
+        cache = {}
+        policy = bugzilla.CachePolicy(stale_while_revalidate=60)
+        cjr = bugzilla.make_caching_json_request(cache, self.jsonreq,
+                                                 policy=policy,
+                                                 timer=lambda: self.now)
+        url = 'http://foo/latest/bug/5'
+        self.assertEqual(cjr('GET', url)['body'], 'first')
+        self.now = 330
+        self.assertEqual(cjr('GET', url)['body'], 'first')
+        self.refreshed.wait(5)
+        for i in range(100):
+            if cache.values()[0]['response']['body'] == 'second':
+                break
+            time.sleep(0.01)
+        self.assertEqual(cjr('GET', url)['body'], 'second')
+
+class RevalidationTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.calls = []
+        self.responses = []
+
+    def jsonreq(self, method, url, query_args=None, body=None,
+                headers=None):
+        self.calls.append((query_args, headers))
+        return self.responses.pop(0)
+
+    def make_request(self):
+        return bugzilla.make_caching_json_request({}, self.jsonreq,
+                                                  timer=lambda: self.now)
+
+    def test_not_modified(self):
+        cjr = self.make_request()
+        self.responses = [{'status': 200, 'etag': '"v1"', 'body': 'full'},
+                          {'status': 304, 'etag': '"v1"', 'body': ''}]
+        cjr('GET', 'http://foo/latest/bug/5')
+        self.now = 1000
+        self.assertEqual(cjr('GET', 'http://foo/latest/bug/5')['body'],
+                         'full')
+        self.assertEqual(self.calls[1][1], {'If-None-Match': '"v1"'})
+        self.now = 1200
+        cjr('GET', 'http://foo/latest/bug/5')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_unchanged_last_change_time(self):
+        attachment = {'status': 200, 'body': TEST_ATTACHMENT_WITH_DATA}
+        probe = {'status': 200, 'body': {
+                'last_change_time': TEST_ATTACHMENT_WITH_DATA[
+                    'last_change_time']
+                }}
+        changed = {'status': 200, 'body': {
+                'last_change_time': '2011-01-01T00:00:00Z'
+                }}
+        self.responses = [attachment, probe, changed, attachment]
+        url = 'http://foo/latest/attachment/438797'
+        # Attachment data is cached forever by default, so use a
+        # policy that expires it.
+        cjr = bugzilla.make_caching_json_request(
+            {}, self.jsonreq, timer=lambda: self.now,
+            policy=bugzilla.CachePolicy(rules=[])
+            )
+        cjr('GET', url, {'attachmentdata': '1'})
+        self.now = 1000
+        self.assertEqual(cjr('GET', url, {'attachmentdata': '1'}),
+                         attachment)
+        self.assertEqual(self.calls[1][0],
+                         {'include_fields': 'last_change_time'})
+        self.now = 2000
+        self.assertEqual(cjr('GET', url, {'attachmentdata': '1'}),
+                         attachment)
+        self.assertEqual(len(self.calls), 4)
+
+class ConcurrencyTests(unittest.TestCase):
+    def setUp(self):
+        self.bzapi = MockBugzillaApi()
+        self.requests = []
+        def request(method, path, query_args=None, body=None):
+            self.requests.append(path)
+            time.sleep(0.05)
+            return {'/bug/558680': TEST_BUG,
+                    '/bug/558681': TEST_BUG_NO_ATTACHMENTS}[path]
+        self.bzapi.request = request
+
+    def tearDown(self):
+        self.bzapi.close()
+
+    def test_map_requests(self):
+        responses = self.bzapi.map_requests([('GET', '/bug/558680'),
+                                             ('GET', '/bug/558681')])
+        self.assertEqual(responses, [TEST_BUG, TEST_BUG_NO_ATTACHMENTS])
+
+    def test_concurrent_gets_fetch_once(self):
+        results = [self.bzapi.bugs.get_async(558680) for i in range(4)]
+        bugs = [result.get() for result in results]
+        self.assertEqual(self.requests, ['/bug/558680'])
+        for bug in bugs:
+            self.assertTrue(bug is bugs[0])
+
+    def test_failed_fetch_is_not_cached(self):
+        self.assertRaises(KeyError, self.bzapi.bugs.get, 1)
+        self.assertRaises(KeyError, self.bzapi.bugs.get, 1)
+        self.assertEqual(self.requests, ['/bug/1', '/bug/1'])
+
+class CoalescingTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def jsonreq(**kwargs):
+            self.calls.append(kwargs['url'])
+            time.sleep(0.05)
+            return {'status': 200, 'content_type': 'application/json',
+                    'body': TEST_BUG}
+        self.bzapi = bugzilla.BugzillaApi(
+            config={'api_server': 'http://foo'},
+            jsonreq=jsonreq
+            )
+
+    def tearDown(self):
+        self.bzapi.close()
+
+    def test_identical_gets_share_one_call(self):
+        results = [self.bzapi.request_async('GET', '/bug/558680')
+                   for i in range(4)]
+        responses = [result.get() for result in results]
+        self.assertEqual(self.calls, ['http://foo/bug/558680'])
+        self.assertEqual(self.bzapi.request_count, 1)
+        for response in responses:
+            self.assertTrue(response is responses[0])
+
+    def test_utf8_query_args(self):
+        self.bzapi.request('GET', '/user', {'match': 'caf\xc3\xa9'})
+        self.assertEqual(self.bzapi.request_count, 1)
+
+    def test_later_gets_are_not_coalesced(self):
+        self.bzapi.request('GET', '/bug/558680')
+        self.bzapi.request('GET', '/bug/558680')
+        self.assertEqual(self.bzapi.request_count, 2)
+
+class SearchTests(unittest.TestCase):
+    def setUp(self):
+        self.bzapi = MockBugzillaApi()
+        self.requests = []
+        def request(method, path, query_args=None, body=None):
+            self.requests.append(query_args)
+            offset = int(query_args['offset'])
+            limit = int(query_args['limit'])
+            ids = range(1000 + offset, min(1000 + offset + limit, 1025))
+            return {'bugs': [dict(TEST_BUG_NO_ATTACHMENTS, id=unicode(i))
+                             for i in ids]}
+        self.bzapi.request = request
+
+    def tearDown(self):
+        self.bzapi.close()
+
+    def test_pages_through_results(self):
+        bugs = list(self.bzapi.bugs.search(page_size=10,
+                                           product='Firefox'))
+        self.assertEqual([bug.id for bug in bugs], range(1000, 1025))
+        self.assertEqual([(args['offset'], args['limit'])
+                          for args in self.requests],
+                         [('0', '10'), ('10', '10'), ('20', '10')])
+        self.assertEqual(self.requests[0]['product'], 'Firefox')
+        self.assertTrue(self.bzapi.bugs.get(1003) is bugs[3])
+
+    def test_next_page_is_requested_early(self):
+        results = self.bzapi.bugs.search(page_size=10)
+        results.next()
+        deadline = time.time() + 1
+        while len(self.requests) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([args['offset'] for args in self.requests],
+                         ['0', '10'])
+
+class JsonStreamReaderTests(unittest.TestCase):
+    def reader(self, text, chunk_size):
+        return bugzilla.JsonStreamReader(StringIO.StringIO(text),
+                                         chunk_size=chunk_size)
+
+    def test_values_match_json_loads(self):
+        doc = {u'a': [1, -2.5e3, True, None, u'{"]\\', {}, []],
+               u'b': {u'c': u'caf\xe9 \u2603', u'd': [[u']'], {u'e': 1}]}}
+        text = bugzilla.json.dumps(doc)
+        for chunk_size in range(1, 12):
+            reader = self.reader(text, chunk_size)
+            values = dict((key, reader.read_value())
+                          for key in reader.iter_members())
+            self.assertEqual(values, doc)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        text = u'{"s": "caf\xe9 \u2603 \\n \u2603"}'.encode('utf-8')
+        for chunk_size in range(1, 8):
+            reader = self.reader(text, chunk_size)
+            for key in reader.iter_members():
+                pieces = list(reader.iter_string())
+            self.assertEqual(u''.join(pieces),
+                             u'caf\xe9 \u2603 \n \u2603')
+
+    def test_truncated_container(self):
+        reader = self.reader('{"a": [1, {"b": "]"}', 4)
+        members = reader.iter_members()
+        members.next()
+        try:
+            reader.read_value()
+        except ValueError, e:
+            self.assertEqual(str(e), 'unexpected end of JSON')
+        else:
+            self.fail('expected ValueError')
+
+class StreamedJsonTests(StubServerTestCase):
+    def responses(self):
+        return {
+            '/bug': {'bugs': [TEST_BUG, TEST_BUG_NO_ATTACHMENTS]},
+            '/bug/558680/attachment': TEST_BUG
+            }
+
+    def test_streamed_search(self):
+        bugs = self.bzapi.bugs.search(stream=True, product='Firefox')
+        self.assertEqual([bug.id for bug in bugs], [558680, 558681])
+        self.assertTrue(self.bzapi.bugs.get(558681).attachments == [])
+
+    def test_streamed_attachments(self):
+        attachments = list(self.bzapi.attachments.iter_bug_attachments(
+            558680
+            ))
+        self.assertEqual([attachment.id for attachment in attachments],
+                         [438381])
+        self.assertTrue(self.bzapi.attachments.get(438381) is
+                        attachments[0])
+
+    def test_streamed_fetch_many(self):
+        bugs = bugzilla.Bug.fetch_many(self.bzapi, [558680, 558681],
+                                       stream=True)
+        self.assertEqual([bug.summary for bug in bugs],
+                         [TEST_BUG['summary'],
+                          TEST_BUG_NO_ATTACHMENTS['summary']])
+
+class ConnectionPoolTests(StubServerTestCase):
+    def responses(self):
+        return {'/bug/558680': TEST_BUG}
+
+    def test_connections_are_reused(self):
+        for i in range(3):
+            self.bzapi.request('GET', '/bug/558680')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnects_when_server_hangs_up(self):
+        self.server.drop_connections = True
+        for i in range(3):
+            response = self.bzapi.request('GET', '/bug/558680')
+            self.assertEqual(response['id'], TEST_BUG['id'])
+        self.assertEqual(self.server.connections, 3)
+
+    def test_posts_never_reuse_connections(self):
+        self.server.drop_connections = True
+        self.bzapi.request('GET', '/bug/558680')
+        for i in range(2):
+            self.bzapi.request('POST', '/bug/558680/attachment',
+                               body={'i': i})
+        self.assertEqual(self.server.posted, [{'i': 0}, {'i': 1}])
+        self.assertEqual(self.server.connections, 3)
+
+class AsyncTests(StubServerTestCase):
+    config = {'max_workers': 2}
+
+    def responses(self):
+        return {
+            '/bug/558680': TEST_BUG,
+            '/attachment/438381': TEST_ATTACHMENT_WITH_DATA,
+            '/user': TEST_USER_SEARCH_RESULT
+            }
+
+    def test_request_async(self):
+        responses = []
+        result = self.bzapi.request_async('GET', '/bug/558680',
+                                          callback=responses.append)
+        self.assertEqual(result.get()['id'], TEST_BUG['id'])
+        self.assertEqual(responses, [result.get()])
+
+    def test_fan_out(self):
+        bug = self.bzapi.bugs.get_async(558680).get()
+        attachment = bug.attachments[0]
+        data = attachment.fetch_data_async()
+        user = attachment.attacher.fulfill_async()
+        self.assertEqual(data.get(), 'testing!')
+        self.assertEqual(user.get().real_name, TEST_USER['real_name'])
+        self.assertEqual(len(self.server.requests), 3)
+
+class UserBatchingTests(StubServerTestCase):
+    def responses(self):
+        attachments = [dict(TEST_BUG['attachments'][0], id=unicode(i),
+                            attacher={'name': name})
+                       for i, name in enumerate([u'avarma', u'asqueella',
+                                                 u'avarma', u'nobody'])]
+        other_user = dict(TEST_USER, name=u'asqueella@mozilla.com',
+                          email=u'asqueella@mozilla.com',
+                          real_name=u'Nickolay Ponomarev')
+        return {
+            '/bug/558680': dict(TEST_BUG, attachments=attachments),
+            '/user': {'users': [TEST_USER, other_user]}
+            }
+
+    def test_attachers_are_fulfilled_together(self):
+        bug = self.bzapi.bugs.get(558680)
+        names = [attachment.attacher.real_name
+                 for attachment in bug.attachments[:3]]
+        self.assertEqual(names, [TEST_USER['real_name'],
+                                 u'Nickolay Ponomarev',
+                                 TEST_USER['real_name']])
+        self.assertRaises(bugzilla.BugzillaApiError,
+                          lambda: bug.attachments[3].attacher.email)
+        self.assertEqual(self.server.requests[1:],
+                         ['/user?match=asqueella&match=avarma'
+                          '&match=nobody', '/user?match=nobody'])
+
+    def test_linked_attachers_can_be_freed(self):
+        self.bzapi.close()
+        self.bzapi = self.make_bzapi(identity_maps={
+            'bugs': 'weak', 'attachments': 'weak', 'users': 'weak'
+            })
+        bug = self.bzapi.bugs.get(558680)
+        self.assertEqual(len(self.bzapi.users), 3)
+        del bug
+        self.assertEqual(len(self.bzapi.users), 0)
+
+    def test_unresolvable_attacher_on_another_bug(self):
+        bug = self.bzapi.bugs.get(558680)
+        self.assertRaises(bugzilla.BugzillaApiError,
+                          lambda: bug.attachments[3].attacher.email)
+        self.assertTrue(self.bzapi.users.get(u'nobody') is
+                        bug.attachments[3].attacher)
+        other = dict(TEST_BUG['attachments'][0], id=u'1000',
+                     attacher={'name': u'nobody'})
+        other_bug = bugzilla.Bug(dict(TEST_BUG, id=u'558690',
+                                      attachments=[other]), self.bzapi)
+        self.assertTrue(other_bug.attachments[0].attacher is
+                        bug.attachments[3].attacher)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_attachers_whose_names_differ_in_case(self):
+        attachments = [dict(TEST_BUG['attachments'][0], id=unicode(i),
+                            attacher={'name': name})
+                       for i, name in enumerate([u'bob@example.com',
+                                                 u'carol@example.com'])]
+        bob = dict(TEST_USER, name=u'Bob@Example.com',
+                   email=u'Bob@Example.com', real_name=u'Bob')
+        carol = dict(TEST_USER, name=u'carol@example.com',
+                     email=u'carol@example.com', real_name=u'Carol')
+        self.server.responses.update({
+            '/bug/558690': dict(TEST_BUG, id=u'558690',
+                                attachments=attachments),
+            '/user': {'users': [bob, carol]}
+            })
+        bug = self.bzapi.bugs.get(558690)
+        self.assertEqual([attachment.attacher.real_name
+                          for attachment in bug.attachments],
+                         [u'Bob', u'Carol'])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse(self.bzapi.users.is_missing(u'bob@example.com'))
+
+    def test_batch_with_no_users_marks_names_missing(self):
+        self.server.responses['/user'] = {'users': []}
+        bug = self.bzapi.bugs.get(558680)
+        self.assertRaises(bugzilla.BugzillaApiError,
+                          lambda: bug.attachments[0].attacher.email)
+        self.assertTrue(self.bzapi.users.is_missing(u'nobody'))
+
+class StreamingTests(StubServerTestCase):
+    def responses(self):
+        attachment = dict(TEST_ATTACHMENT_WITH_DATA,
+                          data=bugzilla.base64.b64encode(self.contents))
+        return {'/attachment/438797': attachment}
+
+    def setUp(self):
+        self.contents = os.urandom(300000)
+        StubServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        StubServerTestCase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def test_save_to(self):
+        attachment = bugzilla.Attachment(TEST_ATTACHMENT_WITHOUT_DATA,
+                                         self.bzapi)
+        path = os.path.join(self.tempdir, 'data')
+        for i in range(2):
+            size = attachment.save_to(path, chunk_size=4096)
+            self.assertEqual(size, len(self.contents))
+            self.assertEqual(open(path, 'rb').read(), self.contents)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_save_to_without_data(self):
+        attachment = dict(TEST_ATTACHMENT_WITH_DATA)
+        del attachment['data']
+        self.server.responses['/attachment/438797'] = attachment
+        attachment = bugzilla.Attachment(TEST_ATTACHMENT_WITHOUT_DATA,
+                                         self.bzapi)
+        path = os.path.join(self.tempdir, 'data')
+        self.assertRaises(bugzilla.BugzillaApiError, attachment.save_to,
+                          path)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_save_to_with_unknown_encoding(self):
+        self.server.responses['/attachment/438797']['encoding'] = 'gzip'
+        attachment = bugzilla.Attachment(TEST_ATTACHMENT_WITHOUT_DATA,
+                                         self.bzapi)
+        path = os.path.join(self.tempdir, 'data')
+        self.assertRaises(NotImplementedError, attachment.save_to, path)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_post_file(self):
+        path = os.path.join(self.tempdir, 'upload.bin')
+        open(path, 'wb').write(self.contents)
+        self.bzapi.attachments.post_file(536619, path, 'big upload',
+                                         content_type='text/plain')
+        posted = self.server.posted[0]
+        self.assertEqual(posted['file_name'], 'upload.bin')
+        self.assertEqual(posted['size'], len(self.contents))
+        self.assertEqual(bugzilla.base64.b64decode(posted['data']),
+                         self.contents)
+
+    def test_post_from_pipe(self):
+        readfd, writefd = os.pipe()
+        os.write(writefd, 'testing!')
+        os.close(writefd)
+        pipe = os.fdopen(readfd, 'rb')
+        try:
+            post = lambda **kwargs: self.bzapi.attachments.post(
+                536619, pipe, 'upload.txt', 'piped upload', **kwargs
+                )
+            self.assertRaises(ValueError, post)
+            post(size=8)
+        finally:
+            pipe.close()
+        self.assertEqual(self.server.posted[0]['data'], 'dGVzdGluZyE=')
+
+class GetManyPatchesTests(StubServerTestCase):
+    def responses(self):
+        return {
+            '/bug': {'bugs': [TEST_BUG, TEST_BUG_NO_ATTACHMENTS]},
+            '/attachment/438381': dict(TEST_ATTACHMENT_WITH_DATA,
+                                       id=u'438381', bug_id=u'558680'),
+            '/user': TEST_USER_SEARCH_RESULT
+            }
+
+    def setUp(self):
+        StubServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        StubServerTestCase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def test_save_patches(self):
+        paths, errors = bzpatch.save_patches(self.bzapi, [558680, 558681],
+                                             self.tempdir)
+        path = os.path.join(self.tempdir, 'bug-558680.patch')
+        self.assertEqual((paths, errors), ({558680: path}, {}))
+        self.assertEqual(open(path).read(),
+                         '# HG changeset patch\n'
+                         '# User Atul Varma [:atul] <avarma@mozilla.com>\n'
+                         'Bug 558680 - Here is a summary\n'
+                         '\n'
+                         'testing!')
+        self.assertEqual(self.bzapi.request_count, 3)
+
+    def test_unknown_bugs_dont_stop_the_others(self):
+        paths, errors = bzpatch.save_patches(self.bzapi,
+                                             [558680, 999999, 558681],
+                                             self.tempdir)
+        self.assertEqual(sorted(paths), [558680])
+        self.assertEqual(sorted(errors), [999999])
+        self.assertTrue(os.path.exists(paths[558680]))
+
+class GetLatestPatchTests(StubServerTestCase):
+    def responses(self):
+        attacher = dict(TEST_USER, name=u'avarma')
+        patch = dict(TEST_BUG['attachments'][0], attacher=attacher)
+        attachments = [
+            patch,
+            dict(patch, id=u'438382', is_obsolete=u'1',
+                 creation_time=u'2010-04-12T19:16:00Z'),
+            dict(patch, id=u'438383', is_patch=u'0',
+                 creation_time=u'2010-04-12T19:16:00Z')
+            ]
+        return {
+            '/bug/558680': dict(TEST_BUG, attachments=attachments),
+            '/attachment/438381': dict(TEST_ATTACHMENT_WITH_DATA,
+                                       id=u'438381', bug_id=u'558680',
+                                       attacher=attacher)
+            }
+
+    def test_at_most_two_requests(self):
+        patch = bzpatch.get_latest_patch(self.bzapi, 558680)
+        self.assertEqual(patch,
+                         '# HG changeset patch\n'
+                         '# User Atul Varma [:atul] <avarma@mozilla.com>\n'
+                         'Bug 558680 - Here is a summary\n'
+                         '\n'
+                         'testing!')
+        self.assertEqual(self.server.requests, [
+            '/bug/558680?include_fields=id%2Csummary%2Cattachments',
+            '/attachment/438381?attachmentdata=1'
+            ])
+
 def get_tests_in_module(module):
     tests = []
 